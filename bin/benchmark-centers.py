@@ -0,0 +1,125 @@
+# Compares the distance-transform center finder used by visitour.py with the
+# original brute-force heuristic, for speed and for the size of the circle
+# each one finds.
+#
+# Usage: python3 ../bin/benchmark-centers.py file.ast [maxNodes]
+#
+# Run from the directory containing the AST file (e.g. world-map/). Each node
+# is rendered once, then both center finders are run on the same image.
+
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import visitour
+from visitour import Colors
+
+
+# The original implementation, operating on a PIL image.
+class LegacyCenter:
+
+    def _circle(self, im, x0, y0, maxr):
+        r = maxr
+        while True:
+            if r > x0 or r > y0 or (x0 + r) >= im.width or (y0 + r) >= im.height:
+                r -= 1
+                break
+
+            p = int(r / math.sqrt(2))
+            if (    im.getpixel( (x0+r, y0  ) ) == Colors.WHITE
+                and im.getpixel( (x0-r, y0  ) ) == Colors.WHITE
+                and im.getpixel( (x0,   y0+r) ) == Colors.WHITE
+                and im.getpixel( (x0,   y0-r) ) == Colors.WHITE
+
+                and im.getpixel( (x0+p, y0+p) ) == Colors.WHITE
+                and im.getpixel( (x0+p, y0-p) ) == Colors.WHITE
+                and im.getpixel( (x0-p, y0+p) ) == Colors.WHITE
+                and im.getpixel( (x0-p, y0-p) ) == Colors.WHITE
+                ):
+                r += 1
+            else:
+                break
+        return r
+
+
+    def _isSolidWhite(self, im, x0, y0, radius):
+        for r in range(1, radius):
+            if (   im.getpixel( (x0+r, y0  ) ) != Colors.WHITE
+                or im.getpixel( (x0-r, y0  ) ) != Colors.WHITE
+                or im.getpixel( (x0,   y0+r) ) != Colors.WHITE
+                or im.getpixel( (x0,   y0-r) ) != Colors.WHITE
+                ):
+                return False
+        return True
+
+
+    def computeCenter(self, img):
+        (wid, hgt) = img.size
+        center_point = None
+        max_radius = 1
+        for x in range(0, wid):
+            for y in range(0, hgt):
+                if img.getpixel((x, y)) == Colors.WHITE:
+                    radius = self._circle(img, x, y, max_radius)
+                    if radius > max_radius and self._isSolidWhite(img, x, y, radius):
+                        max_radius = radius
+                        center_point = (x, y)
+        if not center_point:
+            center_point = (int(wid/2), int(hgt/2))
+        return center_point
+
+
+
+# The radius of the largest circle centered at (x, y) which is all white.
+def trueRadius(dist, x, y):
+    return math.sqrt(dist[y, x])
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 benchmark-centers.py file.ast [maxNodes]')
+        sys.exit(1)
+    astFilename = sys.argv[1]
+    maxNodes = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    ast = visitour.Astree(astFilename)
+    svgname = ast.getSvgname() or '{}.svg'.format(os.path.splitext(astFilename)[0])
+    svg = visitour.Svg(svgname, ast.getNodes())
+    centers = visitour.Centers('tmp')
+    masks = [centers._renderNode(svg, nodeId) for nodeId in sorted(svg.getDatKeys())[:maxNodes]]
+    imgs = [visitour.maskToImage(mask) for mask in masks]
+    print('Rendered {} nodes'.format(len(masks)))
+
+    t0 = time.time()
+    newCenters = [centers._computeCenter(mask)[0:2] for mask in masks]
+    newTime = time.time() - t0
+
+    legacy = LegacyCenter()
+    t0 = time.time()
+    oldCenters = [legacy.computeCenter(img) for img in imgs]
+    oldTime = time.time() - t0
+
+    # Compare the clearance (distance to the outline) of both centers.
+    newRadius = 0.0
+    oldRadius = 0.0
+    better = 0
+    for (mask, new, old) in zip(masks, newCenters, oldCenters):
+        dist = visitour.distanceTransform(mask)
+        rn = trueRadius(dist, *new)
+        ro = trueRadius(dist, *old)
+        newRadius += rn
+        oldRadius += ro
+        if rn > ro:
+            better += 1
+
+    count = max(len(masks), 1)
+    print('Legacy:     {:8.2f} ms/node, mean clearance {:.1f} px'.format(1000 * oldTime / count, oldRadius / count))
+    print('Transform:  {:8.2f} ms/node, mean clearance {:.1f} px'.format(1000 * newTime / count, newRadius / count))
+    if newTime > 0:
+        print('Speedup:    {:8.1f}x'.format(oldTime / newTime))
+    print('Centers with more clearance: {}/{}'.format(better, len(masks)))
+
+
+main()
@@ -0,0 +1,163 @@
+# Compares the speed of the NumPy separation test used by visitour.py with the
+# original pixel-by-pixel implementation, and checks that both give identical
+# results.
+#
+# Usage: python3 ../bin/benchmark-separation.py file.ast [maxPairs]
+#
+# Run from the directory containing the AST file (e.g. us-map/). Pairs of
+# nearby nodes are rendered once, then each separation test is run on the
+# same images.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import visitour
+from visitour import Colors
+
+
+# The original implementation, operating on PIL pixel-access objects.
+class LegacySeparation:
+
+    def __init__(self):
+        self.stack = []
+        self.changed = []
+
+
+    def _floodfill(self, pixels, wid, hgt):
+        while self.stack:
+            (x, y) = self.stack.pop()
+            if pixels[x, y] == Colors.BLACK:
+                pixels[x, y] = Colors.RED
+                self.changed.append((x, y))
+                if (x+1 < wid):
+                    self.stack.append((x+1, y))
+                if (x-1 >= 0):
+                    self.stack.append((x-1, y))
+                if (y+1 < hgt):
+                    self.stack.append((x, y+1))
+                if (y-1 >= 0):
+                    self.stack.append((x, y-1))
+
+
+    def _isVerticalLine(self, pixels, x, hgt):
+        for y in range(0, hgt):
+            if pixels[x, y] == Colors.WHITE:
+                return False
+        return True
+
+
+    def _canDrawVerticalLine(self, pixels, wid, hgt):
+        for x in range(0, wid):
+            if self._isVerticalLine(pixels, x, hgt):
+                return True
+        return False
+
+
+    def _isHorizontalLine(self, pixels, y, wid):
+        for x in range(0, wid):
+            if pixels[x, y] == Colors.WHITE:
+                return False
+        return True
+
+
+    def _canDrawHorizontalLine(self, pixels, wid, hgt):
+        for y in range(0, hgt):
+            if self._isHorizontalLine(pixels, y, wid):
+                return True
+        return False
+
+
+    def _canFloodFillTopToBottom(self, pixels, ww, hh):
+        self.stack = []
+        self.changed = []
+        for w in range(0, ww):
+           if pixels[w, 0] == Colors.BLACK:
+               self.stack.append((w, 0))
+               self._floodfill(pixels, ww, hh)
+        for w in range(0, ww):
+           if pixels[w, hh-1] == Colors.RED:
+               return True
+        return False
+
+
+    def _canFloodFillLeftToRight(self, pixels, ww, hh):
+        self.stack = []
+        self.changed = []
+        for h in range(0, hh):
+            if pixels[0, h] == Colors.BLACK:
+                self.stack.append((0, h))
+                self._floodfill(pixels, ww, hh)
+        for h in range(0, hh):
+            if pixels[ww-1, h] == Colors.RED:
+                return True
+        return False
+
+
+    def _resetChangedPixels(self, pixels):
+        while self.changed:
+            (x, y) = self.changed.pop()
+            pixels[x, y] = Colors.BLACK
+
+
+    def isSeparated(self, img):
+        pixels = img.load()
+        (ww, hh) = img.size
+        if self._canDrawVerticalLine(pixels, ww, hh):
+            return True
+        if self._canDrawHorizontalLine(pixels, ww, hh):
+            return True
+        if self._canFloodFillTopToBottom(pixels, ww, hh):
+            return True
+        self._resetChangedPixels(pixels)
+        if self._canFloodFillLeftToRight(pixels, ww, hh):
+            return True
+        return False
+
+
+
+def renderPairs(astFilename, maxPairs):
+    ast = visitour.Astree(astFilename)
+    svgname = ast.getSvgname() or '{}.svg'.format(os.path.splitext(astFilename)[0])
+    svg = visitour.Svg(svgname, ast.getNodes())
+    neighbors = visitour.Neighbors('tmp')
+    masks = []
+    for (nodeId1, nodeId2) in sorted(neighbors._candidatePairs(svg))[:maxPairs]:
+        mask = neighbors._renderPair(svg, nodeId1, nodeId2)
+        if mask is not None:
+            masks.append(mask)
+    return masks
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 benchmark-separation.py file.ast [maxPairs]')
+        sys.exit(1)
+    maxPairs = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    masks = renderPairs(sys.argv[1], maxPairs)
+    imgs = [visitour.maskToImage(mask) for mask in masks]
+    print('Rendered {} pairs'.format(len(imgs)))
+
+    neighbors = visitour.Neighbors('tmp')
+    t0 = time.time()
+    newResults = [neighbors._isSeparated(mask) for mask in masks]
+    newTime = time.time() - t0
+
+    legacy = LegacySeparation()
+    t0 = time.time()
+    oldResults = [legacy.isSeparated(img.copy()) for img in imgs]
+    oldTime = time.time() - t0
+
+    mismatches = [i for i in range(0, len(imgs)) if oldResults[i] != newResults[i]]
+    count = max(len(imgs), 1)
+    print('Legacy:  {:8.2f} ms/pair'.format(1000 * oldTime / count))
+    print('NumPy:   {:8.2f} ms/pair'.format(1000 * newTime / count))
+    if newTime > 0:
+        print('Speedup: {:8.1f}x'.format(oldTime / newTime))
+    print('Mismatches: {}'.format(len(mismatches)))
+    if mismatches:
+        sys.exit(1)
+
+
+main()
@@ -0,0 +1,124 @@
+# Checks that path data written by --compact-paths (PathData.compact()) reads
+# back as the same geometry: every segment of the original path, with each
+# coordinate within half a rounding step, apart from line segments which
+# become zero-length once rounded, and are left out.
+#
+# Usage: python3 ../bin/check-compact-paths.py file.ast [decimals] [randomPaths]
+#
+# Run from the directory containing the AST file (e.g. world-map/). The paths
+# of every node are checked, then 'randomPaths' (default 1000) random paths
+# using every kind of path command, absolute and relative.
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import visitour
+
+
+# The segments that compact() should write: those of 'pathData', except line
+# segments whose end point rounds to the current point.
+def expectedSegments(pathData, decimals):
+    def rounded(x, y):
+        return (round(x * 10 ** decimals), round(y * 10 ** decimals))
+    segs = []
+    current = None
+    start = None
+    for (cmd, args) in pathData.segments:
+        if cmd == 'Z':
+            current = start
+        else:
+            end = rounded(*args[-2:])
+            if cmd == 'L' and end == current:
+                continue
+            current = end
+            if cmd == 'M':
+                start = end
+        segs.append((cmd, args))
+    return segs
+
+
+# Returns a description of the first difference, or None.
+def compareSegments(expected, actual, decimals):
+    tol = 0.5 * 10 ** -decimals + 1e-6
+    if len(expected) != len(actual):
+        return '{} segments, expected {}'.format(len(actual), len(expected))
+    for (i, ((cmd, args), (acmd, aargs))) in enumerate(zip(expected, actual)):
+        if cmd != acmd or len(args) != len(aargs):
+            return 'segment {}: {} instead of {}'.format(i, acmd, cmd)
+        if cmd == 'A':
+            # Radii are written unsigned, and flags are 0 or 1.
+            args = [abs(args[0]), abs(args[1]), args[2], int(args[3]), int(args[4])] + list(args[5:])
+        for (val, aval) in zip(args, aargs):
+            if abs(val - aval) > tol:
+                return 'segment {}: {} {} instead of {} {}'.format(i, acmd, list(aargs), cmd, list(args))
+    return None
+
+
+def randomPath(rnd):
+    def num():
+        return round(rnd.uniform(-500, 500), rnd.choice([0, 1, 2, 3, 5]))
+    def pos():
+        return round(rnd.uniform(0, 1000), rnd.choice([0, 1, 2, 3, 5]))
+    parts = ['M {} {}'.format(pos(), pos())]
+    for i in range(0, rnd.randint(1, 30)):
+        cmd = rnd.choice('LHVCSQTAZM')
+        rel = rnd.random() < 0.5
+        if cmd in 'LM':
+            args = [num(), num()] if rel else [pos(), pos()]
+            if rnd.random() < 0.1:
+                args = [0, 0] if rel else None
+        elif cmd in 'HV':
+            args = [num()] if rel else [pos()]
+        elif cmd == 'C':
+            args = [num(), num(), num(), num(), num(), num()] if rel else [pos(), pos(), pos(), pos(), pos(), pos()]
+        elif cmd in 'SQ':
+            args = [num(), num(), num(), num()] if rel else [pos(), pos(), pos(), pos()]
+        elif cmd == 'T':
+            args = [num(), num()] if rel else [pos(), pos()]
+        elif cmd == 'A':
+            end = [num(), num()] if rel else [pos(), pos()]
+            args = [abs(num()), abs(num()), num(), rnd.randint(0, 1), rnd.randint(0, 1)] + end
+        else:
+            args = []
+        if args is None:
+            continue
+        parts.append('{} {}'.format(cmd.lower() if rel else cmd, ' '.join([str(val) for val in args])))
+    return ' '.join(parts)
+
+
+def check(d, decimals):
+    pathData = visitour.PathData(d)
+    compact = pathData.compact(decimals)
+    return compareSegments(expectedSegments(pathData, decimals), visitour.PathData(compact).segments, decimals)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 check-compact-paths.py file.ast [decimals] [randomPaths]')
+        sys.exit(1)
+    astFilename = sys.argv[1]
+    decimals = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    ast = visitour.Astree(astFilename)
+    svgname = ast.getSvgname() or '{}.svg'.format(os.path.splitext(astFilename)[0])
+    svg = visitour.Svg(svgname, ast.getNodes())
+    paths = [path['d'] for nodeId in sorted(svg.getDatKeys()) for path in svg.getDatVal(nodeId)['paths']]
+    rnd = random.Random(1)
+    paths.extend([randomPath(rnd) for i in range(0, count)])
+
+    failures = 0
+    for d in paths:
+        problem = check(d, decimals)
+        if problem:
+            failures += 1
+            if failures <= 5:
+                print('{}\n    {}'.format(d[:200], problem))
+    print('Checked {} paths with {} decimal places, {} failures'.format(len(paths), decimals, failures))
+    if failures:
+        sys.exit(1)
+
+
+main()
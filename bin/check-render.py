@@ -0,0 +1,77 @@
+# Checks that nodes rendered straight into memory (renderSvgMask() with
+# MaskSurface) give the same masks as nodes rendered with cairosvg's public
+# svg2png(). Needs cairosvg and cairo itself, not a stand-in: the in-memory
+# buffer belongs to a cairo surface, and reading it once the surface has been
+# destroyed gives garbage, or crashes. After each render the surface is freed,
+# and memory is allocated and written, before the mask is compared.
+#
+# Usage: python3 ../bin/check-render.py file.ast [maxNodes]
+#
+# Run from the directory containing the AST file (e.g. world-map/).
+
+import gc
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import visitour
+
+
+# Reuses freed memory, so that a mask still reading a destroyed surface's
+# buffer no longer matches.
+def churnMemory():
+    gc.collect()
+    for i in range(0, 20):
+        buf = bytearray(b'\xaa') * (2**16 * (i + 1))
+        del buf
+
+
+def renderNode(node, scale, inMemory, maskSurface):
+    visitour.MaskSurface = maskSurface if inMemory else None
+    result = visitour.renderWindowMask([node], visitour.nodeBbox(node), scale)
+    churnMemory()
+    return result
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 check-render.py file.ast [maxNodes]')
+        sys.exit(1)
+    astFilename = sys.argv[1]
+    maxNodes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    maskSurface = visitour.MaskSurface
+    if maskSurface is None:
+        print('Nodes cannot be rendered into memory with this cairosvg; nothing to check')
+        sys.exit(1)
+
+    ast = visitour.Astree(astFilename)
+    svgname = ast.getSvgname() or '{}.svg'.format(os.path.splitext(astFilename)[0])
+    svg = visitour.Svg(svgname, ast.getNodes())
+    nodeIds = sorted(svg.getDatKeys())[:maxNodes]
+
+    failures = 0
+    for nodeId in nodeIds:
+        node = svg.getDatVal(nodeId)
+        box = visitour.nodeBbox(node)
+        if not box:
+            continue
+        scale = visitour.windowScale(svg.width, box)
+        expected = renderNode(node, scale, False, maskSurface)
+        actual = renderNode(node, scale, True, maskSurface)
+        if expected is None or actual is None:
+            same = expected is None and actual is None
+        else:
+            same = expected[:2] == actual[:2] and np.array_equal(expected[2], actual[2])
+        if not same:
+            failures += 1
+            if failures <= 5:
+                print('{}: in-memory mask differs from svg2png()'.format(nodeId))
+    print('Checked {} nodes, {} failures'.format(len(nodeIds), failures))
+    if failures:
+        sys.exit(1)
+
+
+main()
@@ -4,21 +4,109 @@
 # Javascript code which can be used to navigate amongst the nodes in the SVG.
 
 import xml.etree.ElementTree as ElementTree
-from PIL import Image, ImageDraw
-from cairosvg import svg2png
+from PIL import Image
+import cairosvg
+import numpy as np
 import io
 import os
 import ast
+import argparse
 import math
-import sys
+import multiprocessing
+import re
 import errno
+import fcntl
+import hashlib
+import json
+import time
 
 
-# Options for debugging.
+# Options, mostly set from the command line. (See main().)
 class Options:
+    # For debugging.
     save_neighbor_png = False
     save_center_png = False
 
+    # Overrides the 'neighborengine' and 'tolerance' values of the AST file.
+    neighbor_engine = None
+    tolerance = None
+
+    # Overrides the 'centerengine' and 'centerprecision' values of the AST
+    # file.
+    center_engine = None
+    center_precision = None
+
+    # Number of worker processes used for neighbors and centers. 0 means one
+    # per CPU.
+    jobs = 1
+
+    # Approximate size, in pixels, at which areas are rendered when computing
+    # neighbors and centers.
+    precision = 300
+
+    # Nodes sharing at least this many vertices are neighbors, without
+    # further checks. 0 disables this.
+    shared_vertices = 2
+
+    # Write path data with short relative commands and rounded coordinates.
+    # (See Tour._pathDecimals().) 'path_zoom' overrides the expected zoom.
+    compact_paths = False
+    path_zoom = None
+
+    # Simplify the paths of nodes in the HTML, so that no point moves further
+    # than this many SVG units. None disables this.
+    simplify = None
+
+    # Number of levels of detail of the paths of nodes in the HTML, including
+    # the full detail. Less than 2 disables this. (See Tour.jsLod().)
+    lod_levels = 0
+
+    # Write the paths of nodes as a topology of shared arcs. (See
+    # Tour._outputTopology().)
+    topology = False
+
+    # (K, N): only check the pairs of nodes of shard K of N, and write their
+    # results to a shard file, instead of building the HTML. (See
+    # Neighbors.computeShard().)
+    shard = None
+
+    # Add the results of this many shards to the pairs cache before
+    # building. (See Neighbors.mergeShards().)
+    merge_shards = None
+
+    @staticmethod
+    def getJobs():
+        if Options.jobs < 1:
+            return multiprocessing.cpu_count()
+        return Options.jobs
+
+    # Options are copied to worker processes, which might not inherit them.
+    @staticmethod
+    def asDict():
+        return dict([(k, v) for (k, v) in vars(Options).items() if not k.startswith('_') and not callable(v) and not isinstance(v, staticmethod)])
+
+    @staticmethod
+    def setFromDict(dct):
+        for (k, v) in dct.items():
+            setattr(Options, k, v)
+
+
+
+# State of a worker process: the 'payload' given to startWorkers(), a dict
+# holding the object whose method each task calls and the arguments shared by
+# every task. Module-level functions such as _checkPairChunk() run the tasks.
+WORKER = {}
+
+
+def _initWorker(payload, options):
+    Options.setFromDict(options)
+    WORKER.update(payload)
+
+
+# Starts a pool of 'jobs' worker processes, with 'payload' as their WORKER.
+def startWorkers(jobs, payload):
+    return multiprocessing.Pool(jobs, _initWorker, (payload, Options.asDict()))
+
 
 
 class Colors:
@@ -75,25 +163,147 @@ class Astree:
     def getSvgcolors(self):
         return self._astVal('svgcolors', {})
 
+    def getNeighborEngine(self):
+        return self._astVal('neighborengine', 'raster')
+
+    def getTolerance(self):
+        return self._astVal('tolerance', None)
+
+    def getCenterEngine(self):
+        return self._astVal('centerengine', 'raster')
+
+    def getCenterPrecision(self):
+        return self._astVal('centerprecision', None)
+
+    # The file is replaced atomically, so an interrupted write never leaves
+    # a truncated file behind.
     def write(self, dat):
-        fil = open(self.name, 'w')
+        tmpname = '{}.tmp'.format(self.name)
+        fil = open(tmpname, 'w')
         fil.write(prettyPrint(dat))
         fil.close()
+        os.replace(tmpname, self.name)
+
+
+
+# An append-only file of boolean results, each keyed by a string without
+# newlines, kept next to the Astree which holds the results compactly. Each
+# result is flushed to the file as soon as it is added, so results survive
+# the process being killed. compact() writes all results to the Astree and
+# empties the journal.
+class Journal:
+
+    def __init__(self, name, astree):
+        self.name = name
+        self.astree = astree
+        self._fil = None
+        self._compacted = time.time()
+
+
+    # Adds the results in the journal to 'dat'. A line left incomplete by an
+    # interrupted write is ignored. Returns the number of results read.
+    def replay(self, dat):
+        count = 0
+        if os.path.isfile(self.name):
+            fil = open(self.name, 'r')
+            for line in fil:
+                (key, sep, val) = line.rstrip('\n').rpartition(' ')
+                if line.endswith('\n') and key and val in ['0', '1']:
+                    dat[key] = (val == '1')
+                    count += 1
+            fil.close()
+        return count
+
+
+    # 'items' is a list of (key, result).
+    def add(self, items):
+        if self._fil is None:
+            self._fil = open(self.name, 'a')
+        for (key, val) in items:
+            self._fil.write('{} {}\n'.format(key, 1 if val else 0))
+        self._fil.flush()
+
+
+    # The Astree is replaced atomically before the journal is removed, so if
+    # this is interrupted, the results are still in one or the other.
+    def compact(self, dat):
+        self.astree.write(dat)
+        self.close()
+        if os.path.isfile(self.name):
+            os.remove(self.name)
+        self._compacted = time.time()
+
+
+    # Compacts the journal if it was last compacted more than 'secs' ago.
+    def checkpoint(self, dat, secs):
+        if time.time() - self._compacted > secs:
+            self.compact(dat)
+
+
+    def close(self):
+        if self._fil is not None:
+            self._fil.close()
+            self._fil = None
 
 
 
 # Handle SVG data.
 class Svg:
 
-    def __init__(self, name, nodes):
-        self._root = ElementTree.parse(name).getroot()
-        self.width = float(self._root.attrib['width'])
-        self.height = float(self._root.attrib['height'])
+    # Only elements with the ids of 'nodes' (their paths) or 'extra' are
+    # kept; the rest of the file is read but not stored.
+    def __init__(self, name, nodes, extra=None):
+        self.width = None
+        self.height = None
+        wanted = set(extra or [])
+        for node in nodes:
+            wanted.update(node[2])
+        self._ids = self._load(name, wanted)
         self.dat = self._populateDat(nodes)
 
 
+    # Only the extracted data is copied to worker processes, not the
+    # elements.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ids'] = None
+        return state
+
+
+    # Streams the file, mapping each wanted id to the list of elements (below
+    # the root, in document order) which have it. Every other element is
+    # removed from its parent as soon as it has been read, so memory use
+    # depends on the wanted elements rather than on the size of the file.
+    # Ids should be unique, so wanted ids which are duplicated are reported.
+    def _load(self, name, wanted):
+        ids = {}
+        stack = []
+        for (event, elem) in ElementTree.iterparse(name, events=('start', 'end')):
+            if event == 'start':
+                if not stack:
+                    self.width = float(elem.attrib['width'])
+                    self.height = float(elem.attrib['height'])
+                stack.append(elem)
+                continue
+            stack.pop()
+            id = elem.attrib.get('id')
+            if stack and id in wanted:
+                ids.setdefault(id, []).append(elem)
+                # Keep the element (and its attributes), but not its children.
+                del elem[:]
+            elif stack:
+                # 'elem' has just ended, so it is the last child of its parent.
+                del stack[-1][-1]
+        duplicates = sorted([id for (id, elems) in ids.items() if len(elems) > 1])
+        if duplicates:
+            print('Found {} duplicate ids'.format(len(duplicates)))
+            for id in duplicates[:20]:
+                print('    {} ({} elements)'.format(id, len(ids[id])))
+        return ids
+
+
     def getId(self, id):
-        return self._root.findall(".//*[@id='"+id+"']")
+        return self._ids.get(id, [])
 
 
     def getDatVal(self, key):
@@ -127,22 +337,991 @@ class Svg:
 
 
 
+# Parses SVG path data (the 'd' attribute of a path) into a list of absolute
+# segments. Each segment is a tuple of a command and its arguments. Relative
+# commands are made absolute, 'H' and 'V' become 'L', 'S' becomes 'C' and 'T'
+# becomes 'Q', so only 'M', 'L', 'C', 'Q', 'A' and 'Z' remain.
+class PathData:
+
+    ARGCOUNTS = { 'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0 }
+    NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+    SEPARATOR = re.compile(r'[\s,]*')
+    COMMAND = re.compile(r'([MmLlHhVvCcSsQqTtZz])')
+
+
+    def __init__(self, d):
+        self.segments = self._parse(d)
+
+
+    # A PathData made of 'segments', which are absolute, as from _parse().
+    @staticmethod
+    def fromSegments(segments):
+        pathData = PathData('')
+        pathData.segments = segments
+        return pathData
+
+
+    def _skip(self, d, pos):
+        return self.SEPARATOR.match(d, pos).end()
+
+
+    def _readNumber(self, d, pos):
+        match = self.NUMBER.match(d, pos)
+        if not match:
+            raise ValueError('Bad path data at {}: {}'.format(pos, d[pos:pos+20]))
+        return (float(match.group(0)), match.end())
+
+
+    # Arc flags are a single '0' or '1' and need not be followed by a
+    # separator. e.g. 'a 5 5 0 015 5'
+    def _readFlag(self, d, pos):
+        if pos < len(d) and d[pos] in '01':
+            return (float(d[pos]), pos+1)
+        raise ValueError('Bad arc flag at {}: {}'.format(pos, d[pos:pos+20]))
+
+
+    # Paths without arcs are split at each command, and the numbers of each
+    # command are read with a single regular expression. Other paths, and bad
+    # path data, are read a character at a time by _tokenize(), which also
+    # reports the position of errors.
+    def _tokenizeFast(self, d):
+        if 'A' in d or 'a' in d:
+            return None
+        parts = self.COMMAND.split(d)
+        if self.SEPARATOR.fullmatch(parts[0]) is None:
+            return None
+        cmds = []
+        for i in range(1, len(parts), 2):
+            (cmd, text) = (parts[i], parts[i+1])
+            if self.SEPARATOR.fullmatch(self.NUMBER.sub(' ', text)) is None:
+                return None
+            vals = [float(val) for val in self.NUMBER.findall(text)]
+            count = self.ARGCOUNTS[cmd.upper()]
+            if count == 0:
+                if vals:
+                    return None
+                cmds.append((cmd, []))
+                continue
+            if not vals or len(vals) % count:
+                return None
+            cmds.append((cmd, vals[0:count]))
+            # Implicit repeats of 'M' are treated as 'L'.
+            repeat = { 'M': 'L', 'm': 'l' }.get(cmd, cmd)
+            cmds.extend([(repeat, vals[j:j+count]) for j in range(count, len(vals), count)])
+        return cmds
+
+
+    def _tokenize(self, d):
+        cmds = self._tokenizeFast(d)
+        if cmds is not None:
+            return cmds
+        cmds = []
+        pos = self._skip(d, 0)
+        cmd = None
+        while pos < len(d):
+            if d[pos].upper() in self.ARGCOUNTS:
+                cmd = d[pos]
+                pos = self._skip(d, pos+1)
+                if cmd in 'Zz':
+                    cmds.append((cmd, []))
+                    continue
+            elif cmd is None or cmd in 'Zz':
+                raise ValueError('Bad path data at {}: {}'.format(pos, d[pos:pos+20]))
+            args = []
+            for i in range(0, self.ARGCOUNTS[cmd.upper()]):
+                if cmd in 'Aa' and i in (3, 4):
+                    (val, pos) = self._readFlag(d, pos)
+                else:
+                    (val, pos) = self._readNumber(d, pos)
+                args.append(val)
+                pos = self._skip(d, pos)
+            cmds.append((cmd, args))
+            # Implicit repeats of 'M' are treated as 'L'.
+            if cmd == 'M':
+                cmd = 'L'
+            elif cmd == 'm':
+                cmd = 'l'
+        return cmds
+
+
+    def _parse(self, d):
+        segs = []
+        (x, y) = (0.0, 0.0)
+        (sx, sy) = (0.0, 0.0)
+        ctrl = None # Last control point, for 'S' and 'T'
+        prev = None
+        for (cmd, args) in self._tokenize(d):
+            rel = cmd.islower()
+            cmd = cmd.upper()
+            (ox, oy) = (x, y) if rel else (0.0, 0.0)
+            if cmd == 'M':
+                (x, y) = (ox + args[0], oy + args[1])
+                (sx, sy) = (x, y)
+                segs.append(('M', (x, y)))
+            elif cmd == 'L':
+                (x, y) = (ox + args[0], oy + args[1])
+                segs.append(('L', (x, y)))
+            elif cmd == 'H':
+                x = ox + args[0]
+                segs.append(('L', (x, y)))
+            elif cmd == 'V':
+                y = oy + args[0]
+                segs.append(('L', (x, y)))
+            elif cmd == 'C' or cmd == 'S':
+                if cmd == 'C':
+                    (x1, y1) = (ox + args[0], oy + args[1])
+                    args = args[2:]
+                elif prev == 'C':
+                    (x1, y1) = (2*x - ctrl[0], 2*y - ctrl[1])
+                else:
+                    (x1, y1) = (x, y)
+                (x2, y2) = (ox + args[0], oy + args[1])
+                (x, y) = (ox + args[2], oy + args[3])
+                ctrl = (x2, y2)
+                segs.append(('C', (x1, y1, x2, y2, x, y)))
+            elif cmd == 'Q' or cmd == 'T':
+                if cmd == 'Q':
+                    (x1, y1) = (ox + args[0], oy + args[1])
+                    args = args[2:]
+                elif prev == 'Q':
+                    (x1, y1) = (2*x - ctrl[0], 2*y - ctrl[1])
+                else:
+                    (x1, y1) = (x, y)
+                (x, y) = (ox + args[0], oy + args[1])
+                ctrl = (x1, y1)
+                segs.append(('Q', (x1, y1, x, y)))
+            elif cmd == 'A':
+                (x, y) = (ox + args[5], oy + args[6])
+                segs.append(('A', (args[0], args[1], args[2], args[3], args[4], x, y)))
+            elif cmd == 'Z':
+                (x, y) = (sx, sy)
+                segs.append(('Z', ()))
+            prev = segs[-1][0]
+        return segs
+
+
+    # Returns a list of subpaths. Each subpath is a list of (x, y) points.
+    # Curves and arcs are approximated by line segments which deviate from the
+    # true curve by roughly 'tolerance' or less.
+    def polylines(self, tolerance=0.1):
+        lines = []
+        pts = []
+        (x, y) = (0.0, 0.0)
+        for (cmd, args) in self.segments:
+            if cmd == 'M':
+                if len(pts) > 1:
+                    lines.append(pts)
+                pts = [args]
+            elif cmd == 'Z':
+                if pts and pts[0] != pts[-1]:
+                    pts.append(pts[0])
+                if len(pts) > 1:
+                    lines.append(pts)
+                pts = [pts[0]] if pts else []
+                (x, y) = pts[0] if pts else (x, y)
+                continue
+            elif cmd == 'L':
+                pts.append(args)
+            elif cmd == 'C':
+                pts.extend(flattenCubic((x, y), args, tolerance))
+            elif cmd == 'Q':
+                pts.extend(flattenQuadratic((x, y), args, tolerance))
+            elif cmd == 'A':
+                pts.extend(flattenArc((x, y), args, tolerance))
+            (x, y) = pts[-1]
+        if len(pts) > 1:
+            lines.append(pts)
+        return lines
+
+
+    # Returns (minx, miny, maxx, maxy) or None if there is no geometry.
+    def bbox(self, tolerance=0.1):
+        return polylinesBbox(self.polylines(tolerance))
+
+
+    # Returns the path data as short relative commands, with coordinates
+    # rounded to 'decimals' decimal places. Coordinates are rounded before
+    # taking the differences between them, so rounding errors do not add up
+    # along the path. Lines which round to nothing are dropped.
+    def compact(self, decimals):
+        # All arguments are rounded at once, as integer multiples of the
+        # rounding quantum. Arc flags are rounded too, which does no harm.
+        counts = [len(args) for (cmd, args) in self.segments]
+        flat = np.array([val for (cmd, args) in self.segments for val in args], dtype=float)
+        ints = np.rint(flat * 10 ** decimals).astype(np.int64).tolist()
+
+        out = PathWriter(decimals)
+        (x, y) = (0, 0)
+        (sx, sy) = (0, 0)
+        ctrl = None # Last control point, for 's' and 't'
+        prev = None
+        pos = 0
+        for ((cmd, args), count) in zip(self.segments, counts):
+            vals = ints[pos:pos+count]
+            pos += count
+            if cmd == 'M':
+                out.add('m', [vals[0] - x, vals[1] - y])
+                (x, y) = (sx, sy) = (vals[0], vals[1])
+            elif cmd == 'L':
+                (dx, dy) = (vals[0] - x, vals[1] - y)
+                if dx and dy:
+                    out.add('l', [dx, dy])
+                elif dx:
+                    out.add('h', [dx])
+                elif dy:
+                    out.add('v', [dy])
+                (x, y) = (vals[0], vals[1])
+            elif cmd == 'C':
+                (x1, y1, x2, y2, ex, ey) = vals
+                if prev == 'C' and (x1, y1) == (2*x - ctrl[0], 2*y - ctrl[1]):
+                    out.add('s', [x2 - x, y2 - y, ex - x, ey - y])
+                else:
+                    out.add('c', [x1 - x, y1 - y, x2 - x, y2 - y, ex - x, ey - y])
+                ctrl = (x2, y2)
+                (x, y) = (ex, ey)
+            elif cmd == 'Q':
+                (x1, y1, ex, ey) = vals
+                if prev == 'Q' and (x1, y1) == (2*x - ctrl[0], 2*y - ctrl[1]):
+                    out.add('t', [ex - x, ey - y])
+                else:
+                    out.add('q', [x1 - x, y1 - y, ex - x, ey - y])
+                ctrl = (x1, y1)
+                (x, y) = (ex, ey)
+            elif cmd == 'A':
+                (rx, ry, rot, large, sweep, ex, ey) = vals
+                out.add('a', [abs(rx), abs(ry), rot], [int(args[3]), int(args[4])], [ex - x, ey - y])
+                (x, y) = (ex, ey)
+            elif cmd == 'Z':
+                out.add('z', [])
+                (x, y) = (sx, sy)
+            prev = cmd
+        return out.getvalue()
+
+
+
+# Writes path data as compactly as possible: numbers are integer multiples of
+# 10**-decimals, written without leading zeros, and command letters and
+# separators are left out wherever a parser does not need them.
+class PathWriter:
+
+    def __init__(self, decimals):
+        self.decimals = decimals
+        self._parts = []
+        self._last = None     # The last number written, if it was a number
+        self._implicit = None # The command implied by a missing letter
+
+
+    def _number(self, val):
+        if not self.decimals:
+            return str(val)
+        digits = str(abs(val)).rjust(self.decimals + 1, '0')
+        whole = digits[:-self.decimals].lstrip('0')
+        frac = digits[-self.decimals:].rstrip('0')
+        text = '{}.{}'.format(whole, frac) if frac else (whole or '0')
+        return '-' + text if val < 0 else text
+
+
+    def _write(self, text):
+        # A separator is needed unless the sign, or a second decimal point,
+        # ends the previous number.
+        if self._last is not None and not (text[0] == '-' or (text[0] == '.' and '.' in self._last)):
+            self._parts.append(' ')
+        self._parts.append(text)
+        self._last = text
+
+
+    # Adds a command. 'vals' are written as numbers; the lists in 'flags'
+    # (arc flags) are written as they are, followed by the numbers in 'more'.
+    def add(self, cmd, vals, flags=[], more=[]):
+        if cmd != self._implicit or cmd == 'z':
+            self._parts.append(cmd)
+            self._last = None
+        # After 'm', further coordinate pairs are lines.
+        self._implicit = 'l' if cmd == 'm' else (None if cmd == 'z' else cmd)
+        for val in vals:
+            self._write(self._number(val))
+        for flag in flags:
+            self._write(str(flag))
+        for val in more:
+            self._write(self._number(val))
+
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+
+# The outlines of paths split into arcs, as in TopoJSON. Outlines are split at
+# junctions: vertices where outlines which share them go different ways, or
+# where an open outline ends. Each arc is stored once, in a canonical
+# direction, so a border shared by two outlines is one arc. Outlines refer to
+# arcs by index, or by ~index when the arc is used backwards. Vertices are the
+# same if they are equal to within VERTEX_QUANTUM.
+class Topology:
+
+    # 'lines' maps any key to a list of polylines.
+    def __init__(self, lines):
+        self.arcs = []
+        # Maps each key to a list of (closed, list of arc references).
+        self.outlines = {}
+        self._index = {}
+        lines = dict([(key, [line for line in [self._dedupe(line) for line in keyLines] if len(line) > 1])
+                      for (key, keyLines) in lines.items()])
+        junctions = self._junctions(lines.values())
+        for (key, keyLines) in lines.items():
+            self.outlines[key] = [self._split(line, junctions) for line in keyLines]
+
+
+    # Removes points which are the same vertex as the previous point.
+    def _dedupe(self, line):
+        pts = line[0:1]
+        for point in line[1:]:
+            if vertexKey(point) != vertexKey(pts[-1]):
+                pts.append(point)
+        return pts
+
+
+    def _isClosed(self, keys):
+        return len(keys) > 2 and keys[0] == keys[-1]
+
+
+    def _junctions(self, allLines):
+        junctions = set()
+        passes = {}
+        for lines in allLines:
+            for line in lines:
+                keys = [vertexKey(point) for point in line]
+                closed = self._isClosed(keys)
+                if closed:
+                    keys = keys[:-1]
+                else:
+                    junctions.add(keys[0])
+                    junctions.add(keys[-1])
+                for i in range(0 if closed else 1, len(keys) if closed else len(keys) - 1):
+                    pair = frozenset([keys[i-1], keys[(i+1) % len(keys)]])
+                    passes.setdefault(keys[i], set()).add(pair)
+        junctions.update([key for (key, pairs) in passes.items() if len(pairs) > 1])
+        return junctions
+
+
+    # Splits a line into arcs at junctions. A closed line is first rotated to
+    # start at a junction, or if it has none, at its smallest vertex, so that
+    # identical rings are split identically. Returns (closed, references).
+    def _split(self, line, junctions):
+        keys = [vertexKey(point) for point in line]
+        closed = self._isClosed(keys)
+        if closed:
+            (line, keys) = (line[:-1], keys[:-1])
+            cuts = [i for (i, key) in enumerate(keys) if key in junctions]
+            start = cuts[0] if cuts else keys.index(min(keys))
+            line = line[start:] + line[:start+1]
+            keys = keys[start:] + keys[:start+1]
+        cuts = [0] + [i for i in range(1, len(keys) - 1) if keys[i] in junctions] + [len(keys) - 1]
+        return (closed, [self._arcRef(line[i:j+1], keys[i:j+1]) for (i, j) in zip(cuts[:-1], cuts[1:])])
+
+
+    def _arcRef(self, points, keys):
+        forward = tuple(keys)
+        backward = forward[::-1]
+        canonical = min(forward, backward)
+        if canonical not in self._index:
+            self._index[canonical] = len(self.arcs)
+            self.arcs.append(points if canonical == forward else points[::-1])
+        index = self._index[canonical]
+        return index if canonical == forward else ~index
+
+
+    # The points of an outline, made of 'arcs' (e.g. self.arcs, or simplified
+    # arcs) as given by 'refs'. A closed outline ends with its first point.
+    @staticmethod
+    def join(arcs, refs):
+        pts = []
+        for ref in refs:
+            arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            pts.extend(arc if not pts else arc[1:])
+        return pts
+
+
+
+# Simplifies the paths of nodes with the Douglas-Peucker algorithm, so that
+# no point moves further than 'tolerance' SVG units, while keeping borders
+# shared by several paths identical: the outlines are split into arcs (see
+# Topology) and each arc is simplified once, for every outline which uses
+# it, so neighbors still meet without gaps or slivers. Curves are replaced by
+# lines.
+class PathSimplifier:
+
+    # The number of points (coordinate pairs) in each kind of segment.
+    POINTS = { 'M': 1, 'L': 1, 'C': 3, 'Q': 2, 'A': 1, 'Z': 0 }
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.before = 0
+        self.after = 0
+        # Points are written rounded to at most a twentieth of the tolerance.
+        self._decimals = max(0, int(math.ceil(-math.log10(tolerance / 10))))
+
+
+    # 'paths' maps any key to path data. Returns the Topology of the paths,
+    # and its arcs, simplified.
+    def simplifyTopology(self, paths):
+        lines = {}
+        for (key, d) in paths.items():
+            pathData = PathData(d)
+            self.before += sum([self.POINTS[cmd] for (cmd, args) in pathData.segments])
+            lines[key] = pathData.polylines(self.tolerance / 4)
+        topology = Topology(lines)
+        arcs = []
+        for arc in topology.arcs:
+            if vertexKey(arc[0]) == vertexKey(arc[-1]):
+                indexes = self._simplifyClosedArc(arc)
+            else:
+                indexes = douglasPeucker(arc, self.tolerance)
+            arcs.append([arc[i] for i in indexes])
+        for outlines in topology.outlines.values():
+            for (closed, refs) in outlines:
+                pts = Topology.join(arcs, refs)
+                self.after += len(pts) - 1 if closed else len(pts)
+        return (topology, arcs)
+
+
+    # 'paths' maps any key to path data. Returns a dict mapping the same keys
+    # to the simplified path data, written compactly (see PathData.compact())
+    # with 'decimals' decimal places, or by default enough for the tolerance.
+    def simplify(self, paths, decimals=None):
+        (topology, arcs) = self.simplifyTopology(paths)
+        result = {}
+        for (key, outlines) in topology.outlines.items():
+            segments = []
+            for (closed, refs) in outlines:
+                pts = Topology.join(arcs, refs)
+                segments.append(('M', tuple(pts[0])))
+                segments.extend([('L', tuple(pt)) for pt in pts[1:-1 if closed else None]])
+                if closed:
+                    segments.append(('Z', ()))
+            result[key] = PathData.fromSegments(segments).compact(self._decimals if decimals is None else decimals)
+        return result
+
+
+    # An arc which returns to its start is split at the point farthest from
+    # the start, and each half keeps at least one more point, so that the
+    # ring does not collapse.
+    def _simplifyClosedArc(self, pts):
+        if len(pts) < 5:
+            return list(range(0, len(pts)))
+        arr = np.array(pts, dtype=float)
+        far = int(np.argmax(np.hypot(arr[:, 0] - arr[0, 0], arr[:, 1] - arr[0, 1])))
+        cuts = [0, far, len(pts) - 1]
+        for (i, j) in [(0, far), (far, len(pts) - 1)]:
+            if j - i > 1 and len(douglasPeucker(pts[i:j+1], self.tolerance)) == 2:
+                cuts.append(i + 1 + int(np.argmax(segmentDistances(arr[i+1:j], arr[i], arr[j]))))
+        cuts.sort()
+        indexes = [0]
+        for (i, j) in zip(cuts[:-1], cuts[1:]):
+            indexes.extend([i + k for k in douglasPeucker(pts[i:j+1], self.tolerance)][1:])
+        return indexes
+
+
+
+# Returns the bounding box (minx, miny, maxx, maxy) of a list of polylines,
+# or None if there are no points.
+def polylinesBbox(lines):
+    xs = [pt[0] for line in lines for pt in line]
+    ys = [pt[1] for line in lines for pt in line]
+    if not xs:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _curveSteps(length, tolerance):
+    return max(2, min(256, int(math.ceil(math.sqrt(length / max(tolerance, 1e-9))))))
+
+
+def flattenCubic(p0, args, tolerance):
+    (x0, y0) = p0
+    (x1, y1, x2, y2, x3, y3) = args
+    length = math.hypot(x1-x0, y1-y0) + math.hypot(x2-x1, y2-y1) + math.hypot(x3-x2, y3-y2)
+    steps = _curveSteps(length, tolerance)
+    pts = []
+    for i in range(1, steps+1):
+        t = i / steps
+        mt = 1 - t
+        a = mt * mt * mt
+        b = 3 * mt * mt * t
+        c = 3 * mt * t * t
+        d = t * t * t
+        pts.append((a*x0 + b*x1 + c*x2 + d*x3, a*y0 + b*y1 + c*y2 + d*y3))
+    return pts
+
+
+def flattenQuadratic(p0, args, tolerance):
+    (x0, y0) = p0
+    (x1, y1, x2, y2) = args
+    length = math.hypot(x1-x0, y1-y0) + math.hypot(x2-x1, y2-y1)
+    steps = _curveSteps(length, tolerance)
+    pts = []
+    for i in range(1, steps+1):
+        t = i / steps
+        mt = 1 - t
+        pts.append((mt*mt*x0 + 2*mt*t*x1 + t*t*x2, mt*mt*y0 + 2*mt*t*y1 + t*t*y2))
+    return pts
+
+
+# Converts an endpoint-parameterized arc to line segments. See 'Elliptical
+# arc implementation notes' in the SVG specification.
+def flattenArc(p0, args, tolerance):
+    (x1, y1) = p0
+    (rx, ry, angle, largeArc, sweep, x2, y2) = args
+    rx = abs(rx)
+    ry = abs(ry)
+    if rx == 0 or ry == 0 or (x1 == x2 and y1 == y2):
+        return [(x2, y2)]
+    phi = math.radians(angle % 360)
+    cosphi = math.cos(phi)
+    sinphi = math.sin(phi)
+    dx = (x1 - x2) / 2
+    dy = (y1 - y2) / 2
+    x1p = cosphi * dx + sinphi * dy
+    y1p = -sinphi * dx + cosphi * dy
+    lam = (x1p * x1p) / (rx * rx) + (y1p * y1p) / (ry * ry)
+    if lam > 1:
+        rx *= math.sqrt(lam)
+        ry *= math.sqrt(lam)
+    num = rx*rx*ry*ry - rx*rx*y1p*y1p - ry*ry*x1p*x1p
+    den = rx*rx*y1p*y1p + ry*ry*x1p*x1p
+    coef = math.sqrt(max(0.0, num / den)) if den else 0.0
+    if largeArc == sweep:
+        coef = -coef
+    cxp = coef * rx * y1p / ry
+    cyp = -coef * ry * x1p / rx
+    cx = cosphi * cxp - sinphi * cyp + (x1 + x2) / 2
+    cy = sinphi * cxp + cosphi * cyp + (y1 + y2) / 2
+    theta1 = math.atan2((y1p - cyp) / ry, (x1p - cxp) / rx)
+    theta2 = math.atan2((-y1p - cyp) / ry, (-x1p - cxp) / rx)
+    delta = theta2 - theta1
+    if sweep and delta < 0:
+        delta += 2 * math.pi
+    elif not sweep and delta > 0:
+        delta -= 2 * math.pi
+    steps = _curveSteps(abs(delta) * max(rx, ry), tolerance)
+    pts = []
+    for i in range(1, steps):
+        t = theta1 + delta * i / steps
+        ex = rx * math.cos(t)
+        ey = ry * math.sin(t)
+        pts.append((cosphi * ex - sinphi * ey + cx, sinphi * ex + cosphi * ey + cy))
+    pts.append((x2, y2))
+    return pts
+
+
+
+# A uniform grid of bounding boxes. Used to quickly find pairs of boxes that
+# intersect, without comparing every box to every other box.
+class BoxGrid:
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.cells = {}
+        self.cellSize = self._chooseCellSize(boxes)
+        for key in sorted(boxes):
+            for cell in self._cellsOf(boxes[key]):
+                self.cells.setdefault(cell, []).append(key)
+
+
+    # Aim for cells about the size of an average box.
+    def _chooseCellSize(self, boxes):
+        if not boxes:
+            return 1.0
+        total = 0.0
+        for (x0, y0, x1, y1) in boxes.values():
+            total += max(x1 - x0, y1 - y0)
+        return max(total / len(boxes), 1e-6)
+
+
+    def _cellsOf(self, box):
+        (x0, y0, x1, y1) = box
+        cs = self.cellSize
+        for i in range(int(math.floor(x0 / cs)), int(math.floor(x1 / cs)) + 1):
+            for j in range(int(math.floor(y0 / cs)), int(math.floor(y1 / cs)) + 1):
+                yield (i, j)
+
+
+    def _intersect(self, a, b):
+        return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+    # Returns a set of (keyA, keyB) tuples, with keyA < keyB, of all boxes
+    # that intersect.
+    def intersectingPairs(self):
+        pairs = set()
+        for keys in self.cells.values():
+            for i, a in enumerate(keys):
+                for b in keys[i+1:]:
+                    pair = (a, b) if a < b else (b, a)
+                    if pair not in pairs and self._intersect(self.boxes[a], self.boxes[b]):
+                        pairs.add(pair)
+        return pairs
+
+
+
+# A node rendered on its own. 'mask' is True where the node is drawn, and its
+# top left pixel is at (x, y) on the pixel grid shared by all renders at
+# 'scale' pixels per SVG unit. (See renderWindowMask().)
+class NodeMask:
+
+    def __init__(self, x, y, scale, mask):
+        self.x = x
+        self.y = y
+        self.scale = scale
+        self.mask = mask
+
+
+    # The mask at a coarser 'scale', which must be this scale divided by a
+    # power of two. Each coarse pixel covers a square of fine pixels, and is
+    # set if any of them is set.
+    def atScale(self, scale):
+        factor = int(round(self.scale / scale))
+        if factor <= 1:
+            return self
+        x0 = self.x // factor
+        y0 = self.y // factor
+        (hgt, wid) = self.mask.shape
+        x1 = -(-(self.x + wid) // factor)
+        y1 = -(-(self.y + hgt) // factor)
+        padded = np.zeros(((y1 - y0) * factor, (x1 - x0) * factor), dtype=bool)
+        padded[self.y - y0*factor:self.y - y0*factor + hgt, self.x - x0*factor:self.x - x0*factor + wid] = self.mask
+        coarse = padded.reshape(y1 - y0, factor, x1 - x0, factor).any(axis=(1, 3))
+        return NodeMask(x0, y0, scale, coarse)
+
+
+
+# A file of NodeMasks, kept between builds and shared by worker processes,
+# which map it read-only instead of rendering the nodes again. The masks are
+# stored one after another, a byte per pixel, in a data file, and the index
+# (an Astree named 'name') gives the data file and, for the key of each
+# mask, where it is. Only the process which opened the store adds to it, and
+# only if 'writable'. Data is written before the index which refers to it,
+# and the index is replaced atomically, so an interrupted build leaves a
+# usable store.
+class MaskStore:
+
+    def __init__(self, name, writable=True):
+        self.name = name
+        self.writable = writable
+        self._pid = os.getpid()
+        self._lock = self._takeLock() if writable else None
+        if writable and not self._lock:
+            print('Another build is writing {}, only reading it'.format(name))
+            self.writable = False
+        self._indexCache = Astree(name)
+        dat = self._indexCache.asDict()
+        self._data = dat.get('data', '{}.0.bin'.format(os.path.splitext(os.path.basename(name))[0]))
+        self._masks = dat.get('masks', {})
+        self._changed = False
+        self._map = None
+
+
+    # Each process maps the data file itself.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_map'] = None
+        state['_lock'] = None
+        return state
+
+
+    # Only one build at a time writes the store, as appends to the data file
+    # and writes of the index are not otherwise coordinated. Returns the
+    # locked file, or None if another build holds the lock.
+    def _takeLock(self):
+        fil = open('{}.lock'.format(self.name), 'w')
+        try:
+            fcntl.flock(fil, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fil.close()
+            return None
+        return fil
+
+
+    # Stops writing the store, and lets other builds write it.
+    def close(self):
+        if self._lock and self._canWrite():
+            self._lock.close()
+        self._lock = None
+        self.writable = False
+
+
+    def _dataFilename(self):
+        return os.path.join(os.path.dirname(self.name), self._data)
+
+
+    def _canWrite(self):
+        return self.writable and os.getpid() == self._pid
+
+
+    # Returns the data file mapped read-only, mapped again if it has grown
+    # to 'size' bytes since it was mapped, or None if it is too small.
+    def _mapped(self, size):
+        if self._map is None or len(self._map) < size:
+            filename = self._dataFilename()
+            if not os.path.isfile(filename) or os.path.getsize(filename) < size:
+                return None
+            self._map = np.memmap(filename, dtype=bool, mode='r')
+        return self._map
+
+
+    # Returns the NodeMask stored with 'key', whose mask is a read-only view
+    # of the data file, or None.
+    def get(self, key):
+        entry = self._masks.get(key)
+        if entry is None:
+            return None
+        (offset, hgt, wid) = (entry['offset'], entry['height'], entry['width'])
+        data = self._mapped(offset + hgt * wid)
+        if data is None:
+            return None
+        return NodeMask(entry['x'], entry['y'], entry['scale'], data[offset:offset + hgt * wid].reshape(hgt, wid))
+
+
+    def add(self, key, nodeMask):
+        if not self._canWrite():
+            return
+        filename = self._dataFilename()
+        offset = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        fil = open(filename, 'ab')
+        fil.write(np.ascontiguousarray(nodeMask.mask, dtype=bool).tobytes())
+        fil.close()
+        (hgt, wid) = nodeMask.mask.shape
+        self._masks[key] = { 'offset': offset, 'x': nodeMask.x, 'y': nodeMask.y, 'scale': nodeMask.scale, 'height': hgt, 'width': wid }
+        self._changed = True
+
+
+    # Writes the index. If 'keys' is given, masks with other keys are
+    # dropped, and once they take up most of the data file, the kept masks
+    # are copied to a new data file, which replaces the old one when the
+    # index is written.
+    def flush(self, keys=None):
+        if not self._canWrite():
+            return
+        if keys is not None:
+            for key in [key for key in self._masks if key not in keys]:
+                del self._masks[key]
+                self._changed = True
+            filename = self._dataFilename()
+            used = sum([entry['height'] * entry['width'] for entry in self._masks.values()])
+            if os.path.isfile(filename) and os.path.getsize(filename) > 2 * used + 2**20:
+                self._rewrite()
+        if self._changed:
+            self._indexCache.write({ 'data': self._data, 'masks': self._masks })
+            self._changed = False
+
+
+    def _rewrite(self):
+        old = self._dataFilename()
+        data = np.memmap(old, dtype=bool, mode='r')
+        (base, generation, ext) = self._data.rsplit('.', 2)
+        self._data = '{}.{}.{}'.format(base, int(generation) + 1, ext)
+        fil = open(self._dataFilename(), 'wb')
+        offset = 0
+        masks = {}
+        for key in sorted(self._masks):
+            entry = self._masks[key]
+            size = entry['height'] * entry['width']
+            if entry['offset'] + size <= len(data):
+                fil.write(data[entry['offset']:entry['offset'] + size].tobytes())
+                masks[key] = dict(entry, offset=offset)
+                offset += size
+        fil.close()
+        del data
+        self._masks = masks
+        self._map = None
+        self._indexCache.write({ 'data': self._data, 'masks': self._masks })
+        self._changed = False
+        os.remove(old)
+
+
+
+# Renders nodes for Neighbors and Centers. Each node is rendered only once, on
+# its own, at the scale chosen for its own bounding box (see windowScale()).
+# Coarser masks, as used for pairs of nodes, are derived from that render.
+# With a MaskStore, renders are also kept between builds, and worker
+# processes map them from the store rather than render them again.
+class Rasterizer:
+
+    # Bump when the way nodes are rendered changes, so that stored masks are
+    # not reused.
+    VERSION = 1
+
+    # Bounding boxes are those of the polylines of each node flattened to
+    # this tolerance, as by PathData.bbox().
+    BBOX_TOLERANCE = 0.1
+
+    def __init__(self, store=None):
+        self._bboxes = {}
+        self._paths = {}
+        self._polylines = {}
+        self._masks = {}
+        self.store = store
+
+
+    # Masks in the store are mapped by each worker process, not copied to it.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.store:
+            state['_masks'] = {}
+        return state
+
+
+    def nodeBbox(self, svg, nodeId):
+        if nodeId not in self._bboxes:
+            self._bboxes[nodeId] = polylinesBbox(self.nodePolylines(svg, nodeId, self.BBOX_TOLERANCE))
+        return self._bboxes[nodeId]
+
+
+    # The parsed paths of a node. Each path is parsed once per build, however
+    # many of nodeBbox() and the vector engines need it.
+    def nodePaths(self, svg, nodeId):
+        if nodeId not in self._paths:
+            self._paths[nodeId] = [PathData(path['d']) for path in svg.getDatVal(nodeId)['paths']]
+        return self._paths[nodeId]
+
+
+    # The polylines of all the paths of a node (see PathData.polylines()).
+    def nodePolylines(self, svg, nodeId, tolerance):
+        if (nodeId, tolerance) not in self._polylines:
+            lines = []
+            for pathData in self.nodePaths(svg, nodeId):
+                lines.extend(pathData.polylines(tolerance))
+            self._polylines[(nodeId, tolerance)] = lines
+        return self._polylines[(nodeId, tolerance)]
+
+
+    # Used when the bounding box of a node is already known, e.g. from a
+    # previous build.
+    def setNodeBbox(self, nodeId, box):
+        if nodeId not in self._bboxes:
+            self._bboxes[nodeId] = box
+
+
+    # Returns the NodeMask of the node at 'scale', or at the scale chosen for
+    # the node itself if 'scale' is None. 'scale' may not be finer than that,
+    # which holds for any area containing the node. Returns None if the node
+    # draws nothing.
+    def nodeMask(self, svg, nodeId, scale=None):
+        if nodeId not in self._masks:
+            self._masks[nodeId] = self._loadMask(svg, nodeId)
+        nodeMask = self._masks[nodeId]
+        if nodeMask is None or scale is None:
+            return nodeMask
+        return nodeMask.atScale(scale)
+
+
+    # Renders, in Options.jobs worker processes, those of 'nodeIds' which
+    # are not in the store, and adds them to it, so that each is rendered
+    # once, however many workers use it afterwards. Only done with a store
+    # and several jobs; otherwise nodes are rendered when first used.
+    def prepare(self, svg, nodeIds):
+        jobs = Options.getJobs()
+        if not self.store or jobs < 2:
+            return
+        todo = [nodeId for nodeId in sorted(nodeIds)
+                if nodeId not in self._masks and self.nodeBbox(svg, nodeId) and self.store.get(self._maskKey(svg, nodeId)) is None]
+        if not todo:
+            return
+        print('Rendering {} nodes'.format(len(todo)))
+        pool = startWorkers(jobs, { 'rasterizer': self, 'svg': svg })
+        try:
+            for (nodeId, nodeMask) in pool.imap_unordered(_renderMaskWorker, todo):
+                self._masks[nodeId] = nodeMask
+                if nodeMask is not None:
+                    self.store.add(self._maskKey(svg, nodeId), nodeMask)
+        finally:
+            pool.terminate()
+        self.store.flush()
+
+
+    # Writes the store, keeping only the masks of the nodes of 'svg', once
+    # they are no longer being added to.
+    def flush(self, svg):
+        if self.store:
+            self.store.flush(set([self._maskKey(svg, nodeId) for nodeId in svg.getDatKeys() if self.nodeBbox(svg, nodeId)]))
+            self.store.close()
+
+
+    # Identifies the render of a node: its geometry, its scale and how it is
+    # rendered.
+    def _maskKey(self, svg, nodeId):
+        scale = windowScale(svg.width, self.nodeBbox(svg, nodeId))
+        return contentHash([nodeHash(svg.getDatVal(nodeId)), repr(scale), 'raster-{} stroke={}'.format(self.VERSION, STROKE_WIDTH)])
+
+
+    def _loadMask(self, svg, nodeId):
+        if not self.nodeBbox(svg, nodeId):
+            return None
+        key = self._maskKey(svg, nodeId) if self.store else None
+        nodeMask = self.store.get(key) if key else None
+        if nodeMask is None:
+            nodeMask = self._renderMask(svg, nodeId)
+            if key and nodeMask is not None:
+                self.store.add(key, nodeMask)
+        return nodeMask
+
+
+    def _renderMask(self, svg, nodeId):
+        box = self.nodeBbox(svg, nodeId)
+        ownScale = windowScale(svg.width, box)
+        result = renderWindowMask([svg.getDatVal(nodeId)], box, ownScale)
+        return NodeMask(result[0], result[1], ownScale, result[2]) if result else None
+
+
+
+def _renderMaskWorker(nodeId):
+    return (nodeId, WORKER['rasterizer']._renderMask(WORKER['svg'], nodeId))
+
+
+
 # A collection of methods for calculating nodes that are neighbors. The only
 # method that should be called is 'compute()'; all the other methods are
 # private, support methods.
 class Neighbors:
 
-    def __init__(self, tmpdir):
-        self.stack = []
-        self.changed = []
+    VERSION = 3
+
+    # How often, in seconds, the pairs journal is compacted (see Journal).
+    CHECKPOINT_SECS = 10
+
+    # Pairs are checked a tile of nearby nodes at a time (see _tileChunks()).
+    # The most nodes in a tile.
+    TILE_NODES = 32
+
+    def __init__(self, tmpdir, rasterizer=None):
         self.tmpdir = tmpdir if tmpdir else 'tmp'
+        self.rasterizer = rasterizer if rasterizer else Rasterizer()
 
 
+    # Results for each pair of nodes are cached by the content of both nodes
+    # (see _nodeKey()), so they are recomputed if either node changes. A
+    # snapshot of the nodes of the previous build is kept, so that changes
+    # can be reported and unchanged nodes need not be parsed again. The
+    # neighbors cache is written for reference (and merge-ast.py), but is
+    # not read. Results are also journaled as they are found (see
+    # _computeNeighbors()), and the journal left by an interrupted build is
+    # read back, so that a build resumes where the previous one stopped.
     def compute(self, svg, join, snip, pngPrefix):
-        astree = Astree(self._neighborsCacheFilename(pngPrefix))
-        cachedNeighbors = astree.asDict()
+        pairsCache = Astree(self._pairsCacheFilename(pngPrefix))
+        cachedPairs = pairsCache.asDict()
+        journal = Journal(self._pairsJournalFilename(pngPrefix), pairsCache)
+        resumed = journal.replay(cachedPairs)
+        if resumed:
+            print('Resuming with {} pairs from {}'.format(resumed, journal.name))
+        snapshotCache = Astree(self._snapshotFilename(pngPrefix))
+        snapshot = snapshotCache.asDict()
 
-        nbors = self._computeNeighbors(svg, cachedNeighbors, pngPrefix)
+        try:
+            nbors = self._computeNeighbors(svg, cachedPairs, snapshot, pngPrefix, journal)
+        finally:
+            journal.close()
+        journal.compact(cachedPairs)
+        snapshotCache.write(snapshot)
 
         for tuple in join:
             self._addTransit(nbors, tuple[0], tuple[1])
@@ -150,190 +1329,454 @@ class Neighbors:
         for tuple in snip:
             self._delTransit(nbors, tuple[0], tuple[1])
 
-        astree.write(nbors)
+        Astree(self._neighborsCacheFilename(pngPrefix)).write(nbors)
 
         return nbors
 
 
-    def _floodfill(self, pixels, wid, hgt):
-        while self.stack:
-            (x, y) = self.stack.pop()
-            if pixels[x, y] == Colors.BLACK:
-                pixels[x, y] = Colors.RED
-                self.changed.append((x, y))
-                # flood fill surrounding cells:
-                if (x+1 < wid):
-                    self.stack.append((x+1, y))
-                if (x-1 >= 0):
-                    self.stack.append((x-1, y))
-                if (y+1 < hgt):
-                    self.stack.append((x, y+1))
-                if (y-1 >= 0):
-                    self.stack.append((x, y-1))
-
-
-    def _isVerticalLine(self, pixels, x, hgt):
-        for y in range(0, hgt):
-            if pixels[x, y] == Colors.WHITE:
-                return False
-        return True
-
-
-    def _canDrawVerticalLine(self, pixels, wid, hgt):
-        for x in range(0, wid):
-            if self._isVerticalLine(pixels, x, hgt):
-                return True
-        return False
+    # True if there is a path of 4-connected black pixels from the first row
+    # of 'black' to its last row. Each row is split into runs of black pixels,
+    # runs that overlap a run in the previous row are connected, and the
+    # connected runs are given a common label.
+    def _canFloodFillTopToBottom(self, black):
+        (hh, ww) = black.shape
+        padded = np.zeros((hh, ww + 2), dtype=bool)
+        padded[:, 1:-1] = black
+        (rows, cols) = np.nonzero(padded[:, 1:] != padded[:, :-1])
+        runRows = rows[0::2]
+        starts = cols[0::2]
+        ends = cols[1::2]
+        if len(starts) == 0:
+            return False
+
+        # Sort keys which order runs by row, then by column. A run in row y
+        # overlaps the runs lo .. hi-1, which are in row y-1.
+        stride = ww + 2
+        lo = np.searchsorted(runRows * stride + ends, (runRows - 1) * stride + starts, side='right')
+        hi = np.searchsorted(runRows * stride + starts, (runRows - 1) * stride + ends, side='left')
+        counts = np.maximum(hi - lo, 0)
+        a = np.repeat(np.arange(len(starts)), counts)
+        b = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        labels = np.arange(len(starts))
+        while True:
+            low = np.minimum(labels[a], labels[b])
+            hooked = labels.copy()
+            np.minimum.at(hooked, labels[a], low)
+            np.minimum.at(hooked, labels[b], low)
+            while True:
+                jumped = hooked[hooked]
+                if (jumped == hooked).all():
+                    break
+                hooked = jumped
+            if (hooked == labels).all():
+                break
+            labels = hooked
 
+        top = labels[runRows == 0]
+        bottom = labels[runRows == hh - 1]
+        return bool(np.isin(bottom, top).any())
 
-    def _isHorizontalLine(self, pixels, y, wid):
-        for x in range(0, wid):
-            if pixels[x, y] == Colors.WHITE:
-                return False
-        return True
 
+    # 'white' is a 2-D boolean array (rows, columns), True where the image is
+    # white.
+    def _isSeparated(self, white):
+        black = ~white
 
-    def _canDrawHorizontalLine(self, pixels, wid, hgt):
-        for y in range(0, hgt):
-            if self._isHorizontalLine(pixels, y, wid):
-                return True
-        return False
+        # An all-black column or row separates the nodes. Checking for one
+        # first is much cheaper than flood filling.
+        if black.all(axis=0).any():
+            return True
+
+        if black.all(axis=1).any():
+            return True
 
+        if self._canFloodFillTopToBottom(black):
+            return True
 
-    def _canFloodFillTopToBottom(self, pixels, ww, hh):
-        self.stack = []
-        self.changed = []
+        if self._canFloodFillTopToBottom(black.T):
+            return True
 
-        for w in range(0, ww):
-           if pixels[w, 0] == Colors.BLACK:
-               self.stack.append((w, 0))
-               self._floodfill(pixels, ww, hh)
-        # check
-        for w in range(0, ww):
-           if pixels[w, hh-1] == Colors.RED:
-               return True
         return False
 
 
-    def _canFloodFillLeftToRight(self, pixels, ww, hh):
-        self.stack = []
-        self.changed = []
+    def _neighborsPngFilename(self, nodeId1, nodeId2, prefix):
+        return os.path.join(self.tmpdir, '{}_pair_{}_{}.png'.format(prefix, nodeId1, nodeId2))
 
-        for h in range(0, hh):
-            if pixels[0, h] == Colors.BLACK:
-                self.stack.append((0, h))
-                self._floodfill(pixels, ww, hh)
-        # check
-        for h in range(0, hh):
-            if pixels[ww-1, h] == Colors.RED:
-                return True
-        return False
 
+    def _neighborsCacheFilename(self, pngPrefix):
+        return os.path.join(self.tmpdir, '{}_neighbors.cache'.format(pngPrefix))
 
-    def _resetChangedPixels(self, pixels):
-        # Reset changed pixels (change RED to BLACK)
-        while self.changed:
-            (x, y) = self.changed.pop()
-            pixels[x, y] = Colors.BLACK
 
+    def _pairsCacheFilename(self, pngPrefix):
+        return os.path.join(self.tmpdir, '{}_pairs.cache'.format(pngPrefix))
 
-    def _isSeparated(self, img):
-        pixels = img.load()
-        (ww, hh) = img.size
 
-        # Use of canDrawHorizontalLine() and canDrawVerticalLine() are
-        # optimizations that make detection about five times faster.
-        # Use of self.changed is an optimization that keeps track of which
-        # pixels were altered during floodfill so that they can be reverted.
-        # None of the optimizations are actually required.
+    def _shardFilename(self, pngPrefix, shard):
+        return os.path.join(self.tmpdir, '{}_pairs.shard-{}-of-{}'.format(pngPrefix, shard[0], shard[1]))
 
-        if self._canDrawVerticalLine(pixels, ww, hh):
-            return True
 
-        if self._canDrawHorizontalLine(pixels, ww, hh):
-            return True
+    def _pairsJournalFilename(self, pngPrefix):
+        return os.path.join(self.tmpdir, '{}_pairs.journal'.format(pngPrefix))
 
-        if self._canFloodFillTopToBottom(pixels, ww, hh):
-            return True
 
-        self._resetChangedPixels(pixels)
+    def _snapshotFilename(self, pngPrefix):
+        return os.path.join(self.tmpdir, '{}_snapshot.cache'.format(pngPrefix))
 
-        if self._canFloodFillLeftToRight(pixels, ww, hh):
-            return True
 
-        return False
+    # Combines the NodeMasks of two nodes, at the same scale, into one mask
+    # covering both.
+    def _pairMask(self, maskA, maskB):
+        (xa, ya, ma) = (maskA.x, maskA.y, maskA.mask)
+        (xb, yb, mb) = (maskB.x, maskB.y, maskB.mask)
+        x0 = min(xa, xb)
+        y0 = min(ya, yb)
+        x1 = max(xa + ma.shape[1], xb + mb.shape[1])
+        y1 = max(ya + ma.shape[0], yb + mb.shape[0])
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        mask[ya-y0:ya-y0+ma.shape[0], xa-x0:xa-x0+ma.shape[1]] |= ma
+        mask[yb-y0:yb-y0+mb.shape[0], xb-x0:xb-x0+mb.shape[1]] |= mb
+        return mask
 
 
-    def _generateNeighborsSvg(self, nodeA, nodeB, svgWidth, svgHeight):
-        # Enlarging small SVG images gives more accurate results, but requires
-        # more processing time.
-        displayWidth = 1200.0 # Arbitrary
-        if svgWidth > displayWidth:
-            displayWidth = svgWidth
+    # Both nodes are rendered at a scale chosen from the size of the area
+    # they cover together, so small pairs are rendered small but in detail.
+    # Returns the mask of the pair, or None if either node draws nothing.
+    def _renderPair(self, svg, nodeId1, nodeId2):
+        boxA = self._nodeBbox(svg, nodeId1)
+        boxB = self._nodeBbox(svg, nodeId2)
+        if not boxA or not boxB:
+            return None
+        scale = windowScale(svg.width, unionBbox(boxA, boxB))
+        maskA = self.rasterizer.nodeMask(svg, nodeId1, scale)
+        maskB = self.rasterizer.nodeMask(svg, nodeId2, scale)
+        if maskA is None or maskB is None:
+            return None
+        return self._pairMask(maskA, maskB)
 
-        scale = svgWidth / displayWidth
-        scaledWid = svgWidth / scale
-        scaledHgt = svgHeight / scale
 
-        lines = []
-        lines.append('<?xml version="1.0" encoding="UTF-8"?>')
-        lines.append('<svg width="{}" height="{}" id="svgimg" viewBox="0 0  {} {}" xmlns="http://www.w3.org/2000/svg">'.format(scaledWid, scaledHgt, svgWidth, svgHeight))
-        for node in [nodeA, nodeB]:
-            lines.append('    <g id="g_{0}" class="g_{0}">'.format(node['nodeId']))
-            for path in node['paths']:
-                lines.append('        <path id="{}" stroke-width="1" stroke="white" fill="white" d="{}" />'.format(path['pathId'], path['d']))
-            lines.append('    </g>')
-        lines.append('</svg>\n')
-        return '\n'.join(lines)
+    def _areNeighbors(self, svg, nodeId1, nodeId2, pngPrefix):
+        mask = self._renderPair(svg, nodeId1, nodeId2)
+        if mask is None:
+            return False
+        if Options.save_neighbor_png:
+            maskToImage(mask).save(self._neighborsPngFilename(nodeId1, nodeId2, pngPrefix))
+        return not self._isSeparated(mask)
 
 
-    def _neighborsPngFilename(self, nodeId1, nodeId2, prefix):
-        return os.path.join(self.tmpdir, '{}_pair_{}_{}.png'.format(prefix, nodeId1, nodeId2))
+    # The distance (in SVG units) within which two nodes might be detected as
+    # neighbors: the stroke width drawn around each path, plus a couple of
+    # pixels (at the coarsest scale) for anti-aliasing.
+    def _tolerance(self, svg):
+        return STROKE_WIDTH + 2 / baseScale(svg.width)
 
 
-    def _neighborsCacheFilename(self, pngPrefix):
-        return os.path.join(self.tmpdir, '{}_neighbors.cache'.format(pngPrefix))
+    def _nodeBbox(self, svg, nodeId):
+        return self.rasterizer.nodeBbox(svg, nodeId)
 
 
-    def _areNeighbors(self, svg, nodeId1, nodeId2, pngPrefix):
-        nodeA = svg.getDatVal(nodeId1)
-        nodeB = svg.getDatVal(nodeId2)
-        img = convertSvgToImg(self._generateNeighborsSvg(nodeA, nodeB, svg.width, svg.height))
-        if Options.save_neighbor_png:
-            img.save(self._neighborsPngFilename(nodeId1, nodeId2, pngPrefix))
-        return not self._isSeparated(img)
+    # Nodes can only be neighbors if their bounding boxes, grown by the
+    # tolerance, intersect. Returns the set of such (nodeId1, nodeId2) pairs.
+    def _candidatePairs(self, svg):
+        tol = self._tolerance(svg)
+        boxes = {}
+        for nodeId in svg.getDatKeys():
+            box = self._nodeBbox(svg, nodeId)
+            if box:
+                boxes[nodeId] = (box[0] - tol, box[1] - tol, box[2] + tol, box[3] + tol)
+        return BoxGrid(boxes).intersectingPairs()
 
 
-    def _computeNeighbors(self, svg, cachedNeighbors, pngPrefix):
-        neighbors = {}
-        nids_todo = []
-        nids_done = []
+    # Identifies how neighbors are computed. Results computed differently
+    # are not reused. Bump VERSION when the algorithm changes. Nodes are
+    # rendered at multiples of the base scale, which depends on the width of
+    # the SVG.
+    def _engineKey(self, svg):
+        return 'raster-{} precision={} stroke={} shared={} base={!r}'.format(self.VERSION, Options.precision, STROKE_WIDTH, Options.shared_vertices, baseScale(svg.width))
+
+
+    # A hash of the node's geometry and of the engine.
+    def _nodeKey(self, svg, node):
+        return contentHash([nodeHash(node), self._engineKey(svg)])
+
+
+    # The key of a pair does not depend on the order of the nodes.
+    def _pairKey(self, keys, nodeId1, nodeId2):
+        return ' '.join(sorted([keys[nodeId1], keys[nodeId2]]))
+
+
+    # Compares the nodes with the snapshot of the previous build. Bounding
+    # boxes of unchanged nodes are taken from the snapshot.
+    def _diffSnapshot(self, keys, snapshot):
+        added = []
+        modified = []
+        for nodeId in sorted(keys):
+            if nodeId not in snapshot:
+                added.append(nodeId)
+            elif snapshot[nodeId]['hash'] != keys[nodeId]:
+                modified.append(nodeId)
+            else:
+                self.rasterizer.setNodeBbox(nodeId, snapshot[nodeId]['bbox'])
+        removed = [nodeId for nodeId in sorted(snapshot) if nodeId not in keys]
+        unchanged = len(keys) - len(added) - len(modified)
+        print('Nodes: {} added, {} modified, {} removed, {} unchanged'.format(len(added), len(modified), len(removed), unchanged))
+        for (label, nodeIds) in [('Added', added), ('Modified', modified), ('Removed', removed)]:
+            if nodeIds and len(nodeIds) <= 20:
+                print('    {}: {}'.format(label, ' '.join(nodeIds)))
+
+
+    # Checks every nearby pair of nodes whose result is not in 'cachedPairs',
+    # which, if the cache is complete, are the pairs involving added or
+    # modified nodes. Results are added to 'cachedPairs', and entries which
+    # no longer refer to current nodes are removed from it. 'snapshot' is
+    # replaced with the current nodes.
+    def _computeNeighbors(self, svg, cachedPairs, snapshot, pngPrefix, journal=None):
         sortedNodeIds = sorted(svg.dat.keys())
-        togo = 0
+        keys = self._nodeKeys(svg)
+        self._diffSnapshot(keys, snapshot)
 
+        pairs = sorted(self._candidatePairs(svg))
+        distant = len(sortedNodeIds) * (len(sortedNodeIds) - 1) // 2 - len(pairs)
+        print('Skipping {} distant pairs'.format(distant))
+        self._checkUncachedPairs(svg, pairs, keys, cachedPairs, pngPrefix, journal)
+
+        neighbors = {}
         for nodeId in sortedNodeIds:
-            if nodeId in cachedNeighbors:
-                neighbors[nodeId] = cachedNeighbors[nodeId]
-                nids_done.append(nodeId)
-            else:
-               nids_todo.append(nodeId)
-               togo += len(sortedNodeIds) - len(nids_todo)
-
-        nids_all = nids_todo + nids_done
-        for i, nodeId1 in enumerate(nids_todo):
-            for nodeId2 in nids_all[i+1:]:
-                print('Checking {}  {}    {}'.format(nodeId1, nodeId2, togo))
-                if (self._areNeighbors(svg, nodeId1, nodeId2, pngPrefix)):
-                    print ('     neighbors')
-                    self._addTransit(neighbors, nodeId1, nodeId2)
-                togo -= 1
+            neighbors[nodeId] = []
+        for (nodeId1, nodeId2) in pairs:
+            if cachedPairs[self._pairKey(keys, nodeId1, nodeId2)]:
+                self._addTransit(neighbors, nodeId1, nodeId2)
 
+        current = set(keys.values())
+        for pairKey in list(cachedPairs.keys()):
+            if not all([key in current for key in pairKey.split(' ')]):
+                del cachedPairs[pairKey]
+
+        snapshot.clear()
         for nodeId in sortedNodeIds:
-           if nodeId not in neighbors:
-               neighbors[nodeId] = []
+            snapshot[nodeId] = { 'hash': keys[nodeId], 'bbox': self._nodeBbox(svg, nodeId) }
 
         return neighbors
 
+
+    def _nodeKeys(self, svg):
+        return dict([(nodeId, self._nodeKey(svg, svg.getDatVal(nodeId))) for nodeId in sorted(svg.dat.keys())])
+
+
+    # Checks each of 'pairs' whose result is not in 'cachedPairs', and adds
+    # the results to it. 'keys' maps each nodeId to its key. If 'journal' is
+    # given, results are added to it as each chunk of pairs is checked, and
+    # it is compacted every CHECKPOINT_SECS.
+    def _checkUncachedPairs(self, svg, pairs, keys, cachedPairs, pngPrefix, journal=None):
+        todo = [pair for pair in pairs if self._pairKey(keys, *pair) not in cachedPairs]
+        print('Skipping {} cached pairs, checking {} pairs'.format(len(pairs) - len(todo), len(todo)))
+
+        shared = self._sharedVertexPairs(svg, todo)
+        if shared:
+            print('Found {} pairs sharing vertices'.format(len(shared)))
+            self._recordPairs(sorted(shared), [True] * len(shared), keys, cachedPairs, journal)
+            todo = [pair for pair in todo if pair not in shared]
+
+        self._checkPairs(svg, todo, pngPrefix,
+                         lambda pairs, results: self._recordPairs(pairs, results, keys, cachedPairs, journal))
+
+
+    # Adds the 'results' of checking 'pairs' to 'cachedPairs', and to
+    # 'journal' if given.
+    def _recordPairs(self, pairs, results, keys, cachedPairs, journal):
+        items = [(self._pairKey(keys, *pair), result) for (pair, result) in zip(pairs, results)]
+        cachedPairs.update(items)
+        if journal:
+            journal.add(items)
+            journal.checkpoint(cachedPairs, self.CHECKPOINT_SECS)
+
+
+    # Checks only the pairs of shard 'shard' = (k, n), 1 <= k <= n, of the
+    # nearby pairs of nodes (see _shardPairs()), and writes their results to
+    # the shard file, which mergeShards() adds to the pairs cache. Results in
+    # the pairs cache are reused, but the pairs cache is not written, so all
+    # shards can run at once, on one machine or on several. Results are
+    # journaled as in compute(), but compacted into a partial file, which
+    # only becomes the shard file once every pair has been checked, so an
+    # interrupted shard resumes, and is never taken for a finished one.
+    def computeShard(self, svg, pngPrefix, shard):
+        keys = self._nodeKeys(svg)
+        pairs = self._shardPairs(svg, sorted(self._candidatePairs(svg)), shard)
+        print('Shard {}/{}: {} pairs'.format(shard[0], shard[1], len(pairs)))
+        pairKeys = [self._pairKey(keys, *pair) for pair in pairs]
+
+        shardFilename = self._shardFilename(pngPrefix, shard)
+        partial = Astree('{}.partial'.format(shardFilename))
+        journal = Journal('{}.journal'.format(partial.name), partial)
+        cachedPairs = {}
+        for dat in [Astree(self._pairsCacheFilename(pngPrefix)).asDict(), Astree(shardFilename).asDict()]:
+            cachedPairs.update([(key, dat[key]) for key in pairKeys if key in dat])
+        cachedPairs.update(partial.asDict())
+        journal.replay(cachedPairs)
+
+        try:
+            self._checkUncachedPairs(svg, pairs, keys, cachedPairs, pngPrefix, journal)
+        finally:
+            journal.close()
+        journal.compact(dict([(key, cachedPairs[key]) for key in pairKeys]))
+        os.replace(partial.name, shardFilename)
+        print('Wrote {}'.format(shardFilename))
+
+
+    # Adds the results in the files of shards 1 to 'count' (see
+    # computeShard()) to the pairs cache. Every shard must have finished: a
+    # shard file is only written once all of its pairs have been checked.
+    def mergeShards(self, pngPrefix, count):
+        names = [self._shardFilename(pngPrefix, (k, count)) for k in range(1, count + 1)]
+        unfinished = [name for name in names if not os.path.isfile(name)]
+        if unfinished:
+            raise Exception('Unfinished shards: {}'.format(' '.join(unfinished)))
+        pairsCache = Astree(self._pairsCacheFilename(pngPrefix))
+        cachedPairs = pairsCache.asDict()
+        for name in names:
+            cachedPairs.update(Astree(name).asDict())
+        pairsCache.write(cachedPairs)
+        print('Merged {} shards into {}'.format(count, pairsCache.name))
+
+
+    # Pairs are given to shards a tile at a time (see _tileChunks()), in
+    # turn, so that each shard renders the nodes of a few areas of the SVG.
+    # Tiles only depend on the nodes and on the number of shards, so every
+    # shard splits the pairs the same way.
+    def _shardPairs(self, svg, pairs, shard):
+        (k, n) = shard
+        chunks = self._tileChunks(svg, pairs, n)
+        return sorted([pair for (i, chunk) in enumerate(chunks) if i % n == k - 1 for pair in chunk])
+
+
+    # The vertices (end points of segments) of a node, rounded to
+    # VERTEX_QUANTUM.
+    def _nodeVertices(self, node):
+        vertices = set()
+        for path in node['paths']:
+            for (cmd, args) in PathData(path['d']).segments:
+                if cmd != 'Z':
+                    vertices.add(vertexKey(args[-2:]))
+        return vertices
+
+
+    # Maps often give adjacent regions identical border coordinates. Returns
+    # the set of 'pairs' which share at least Options.shared_vertices
+    # vertices, and so are certainly neighbors. Each node is scanned once.
+    def _sharedVertexPairs(self, svg, pairs):
+        if Options.shared_vertices < 1 or not pairs:
+            return set()
+        index = {}
+        for nodeId in sorted(set([nodeId for pair in pairs for nodeId in pair])):
+            for vertex in self._nodeVertices(svg.getDatVal(nodeId)):
+                index.setdefault(vertex, []).append(nodeId)
+
+        wanted = set(pairs)
+        counts = {}
+        for nodeIds in index.values():
+            for i, nodeId1 in enumerate(nodeIds):
+                for nodeId2 in nodeIds[i+1:]:
+                    if (nodeId1, nodeId2) in wanted:
+                        counts[(nodeId1, nodeId2)] = counts.get((nodeId1, nodeId2), 0) + 1
+        return set([pair for (pair, count) in counts.items() if count >= Options.shared_vertices])
+
+
+    # Splits 'nodeIds' into tiles of at most 'size' nodes, by cutting each
+    # tile in two at the median of the centers of the bounding boxes of its
+    # nodes, across its longer side. Returns a dict mapping each nodeId to
+    # the index of its tile.
+    def _tiles(self, svg, nodeIds, size):
+        centers = {}
+        for nodeId in nodeIds:
+            box = self._nodeBbox(svg, nodeId)
+            centers[nodeId] = ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)
+        tiles = {}
+        count = 0
+        stack = [sorted(nodeIds)]
+        while stack:
+            group = stack.pop()
+            if len(group) <= size:
+                for nodeId in group:
+                    tiles[nodeId] = count
+                count += 1
+                continue
+            xs = [centers[nodeId][0] for nodeId in group]
+            ys = [centers[nodeId][1] for nodeId in group]
+            axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+            group = sorted(group, key=lambda nodeId: (centers[nodeId][axis], nodeId))
+            half = len(group) // 2
+            stack.append(group[half:])
+            stack.append(group[:half])
+        return tiles
+
+
+    # Splits 'pairs' into chunks of work by tile (see _tiles()): for each
+    # tile, the pairs within it, and the pairs between it and later tiles,
+    # which are only pairs of nodes near the border of the tile. A worker
+    # given a chunk renders the nodes of one area of the SVG, rather than
+    # nodes from all over it. Tiles are made small enough to give each of
+    # 'parts' (jobs, or shards) several tiles.
+    def _tileChunks(self, svg, pairs, parts):
+        nodeIds = set([nodeId for pair in pairs for nodeId in pair])
+        size = max(4, min(self.TILE_NODES, int(math.ceil(len(nodeIds) / (parts * 4.0)))))
+        tiles = self._tiles(svg, nodeIds, size)
+        inner = {}
+        border = {}
+        for pair in pairs:
+            (tile1, tile2) = (tiles[pair[0]], tiles[pair[1]])
+            if tile1 == tile2:
+                inner.setdefault(tile1, []).append(pair)
+            else:
+                border.setdefault(min(tile1, tile2), []).append(pair)
+        return [inner.get(tile, []) + border.get(tile, []) for tile in sorted(set(inner) | set(border))]
+
+
+    # Returns a list of booleans, one for each (nodeId1, nodeId2) in 'pairs',
+    # which is True if the nodes are neighbors. Pairs are checked in chunks
+    # (see _tileChunks()), in parallel if Options.jobs is more than 1, and
+    # 'done', if given, is called with each chunk and its results as soon as
+    # it is checked. Results are returned in the same order as 'pairs'
+    # regardless of the number of jobs.
+    def _checkPairs(self, svg, pairs, pngPrefix, done=None):
+        jobs = Options.getJobs()
+        chunks = self._tileChunks(svg, pairs, jobs)
+        if chunks:
+            print('Checking pairs in {} tiles'.format(len(chunks)))
+
+        results = {}
+        found = 0
+        if jobs > 1 and len(chunks) > 1:
+            self._prepareMasks(svg, set([nodeId for pair in pairs for nodeId in pair]))
+            pool = startWorkers(jobs, { 'neighbors': self, 'svg': svg, 'pngPrefix': pngPrefix })
+            chunkResults = pool.imap_unordered(_checkPairChunk, chunks)
+        else:
+            pool = None
+            chunkResults = (self._checkPairChunk(svg, chunk, pngPrefix) for chunk in chunks)
+        try:
+            for (chunk, chunkResult) in chunkResults:
+                results.update(zip(chunk, chunkResult))
+                found += chunkResult.count(True)
+                print('Checked {}/{} pairs, {} neighbors'.format(len(results), len(pairs), found))
+                if done:
+                    done(chunk, chunkResult)
+        finally:
+            if pool:
+                pool.terminate()
+        return [results[pair] for pair in pairs]
+
+
+    # Renders the nodes before worker processes start, so that each is
+    # rendered once (see Rasterizer.prepare()). Also used by Centers. The
+    # vector engines render nothing, and override this to do nothing.
+    def _prepareMasks(self, svg, nodeIds):
+        self.rasterizer.prepare(svg, nodeIds)
+
+
+    # Returns the chunk, and the result for each of its pairs.
+    def _checkPairChunk(self, svg, chunk, pngPrefix):
+        return (chunk, [self._areNeighbors(svg, nodeId1, nodeId2, pngPrefix) for (nodeId1, nodeId2) in chunk])
+
+
     # Make 'a' and 'b' neighbors.
     def _addTransit(self, nbors, a, b):
         if a not in nbors:
@@ -358,159 +1801,310 @@ class Neighbors:
 
 
 
+def _checkPairChunk(chunk):
+    return WORKER['neighbors']._checkPairChunk(WORKER['svg'], chunk, WORKER['pngPrefix'])
+
+
+
+# Detects neighbors from the geometry of the paths, without rendering
+# anything. Two nodes are neighbors if their outlines come within 'tolerance'
+# SVG units of each other, or if one lies inside the other.
+class VectorNeighbors(Neighbors):
+
+    VERSION = 1
+
+    def __init__(self, tmpdir, tolerance=None, rasterizer=None):
+        super().__init__(tmpdir, rasterizer)
+        # The raster engine draws a stroke of width 1 around each path, so
+        # outlines closer than that will touch. A little more is allowed for
+        # anti-aliasing.
+        self.tolerance = tolerance if tolerance is not None else 1.5
+        self._grids = {}
+        self._lineBboxes = {}
+
+
+    def _tolerance(self, svg):
+        return self.tolerance
+
+
+    def _engineKey(self, svg):
+        return 'vector-{} tolerance={} shared={}'.format(self.VERSION, self.tolerance, Options.shared_vertices)
+
+
+    def _prepareMasks(self, svg, nodeIds):
+        pass
+
+
+    def _nodePolylines(self, svg, nodeId):
+        lines = self.rasterizer.nodePolylines(svg, nodeId, self.tolerance / 4)
+        if nodeId not in self._lineBboxes:
+            self._lineBboxes[nodeId] = polylinesBbox(lines)
+        return lines
+
+
+    def _nodeGrid(self, svg, nodeId):
+        if nodeId not in self._grids:
+            self._grids[nodeId] = SegmentGrid(self._nodePolylines(svg, nodeId), self.tolerance)
+        return self._grids[nodeId]
+
+
+    def _areNeighbors(self, svg, nodeId1, nodeId2, pngPrefix):
+        linesA = self._nodePolylines(svg, nodeId1)
+        linesB = self._nodePolylines(svg, nodeId2)
+        if not linesA or not linesB:
+            return False
+
+        tol = self.tolerance
+        (bx0, by0, bx1, by1) = self._lineBboxes[nodeId2]
+        grid = self._nodeGrid(svg, nodeId2)
+        for line in linesA:
+            for i in range(1, len(line)):
+                (x1, y1) = line[i-1]
+                (x2, y2) = line[i]
+                if (max(x1, x2) < bx0 - tol or min(x1, x2) > bx1 + tol
+                    or max(y1, y2) < by0 - tol or min(y1, y2) > by1 + tol):
+                    continue
+                if grid.isNear(line[i-1], line[i], tol):
+                    return True
+
+        # The outlines are apart, but one node may be inside the other.
+        return (pointInPolylines(linesA[0][0], linesB)
+                or pointInPolylines(linesB[0][0], linesA))
+
+
+
+# An index of the line segments of a set of polylines, for finding segments
+# that are near a given segment.
+class SegmentGrid:
+
+    def __init__(self, lines, cellSize):
+        self.cells = {}
+        self.cellSize = max(cellSize, self._averageLength(lines), 1e-6)
+        for line in lines:
+            for i in range(1, len(line)):
+                seg = (line[i-1], line[i])
+                for cell in self._cellsOf(seg[0], seg[1], 0):
+                    self.cells.setdefault(cell, []).append(seg)
+
+
+    def _averageLength(self, lines):
+        total = 0.0
+        count = 0
+        for line in lines:
+            for i in range(1, len(line)):
+                total += math.hypot(line[i][0] - line[i-1][0], line[i][1] - line[i-1][1])
+                count += 1
+        return total / count if count else 0.0
+
+
+    def _cellsOf(self, p, q, grow):
+        cs = self.cellSize
+        for i in range(int(math.floor((min(p[0], q[0]) - grow) / cs)), int(math.floor((max(p[0], q[0]) + grow) / cs)) + 1):
+            for j in range(int(math.floor((min(p[1], q[1]) - grow) / cs)), int(math.floor((max(p[1], q[1]) + grow) / cs)) + 1):
+                yield (i, j)
+
+
+    # True if any indexed segment is within 'tol' of the segment p-q.
+    def isNear(self, p, q, tol):
+        for cell in self._cellsOf(p, q, tol):
+            for (a, b) in self.cells.get(cell, []):
+                if segmentDistance(p, q, a, b) <= tol:
+                    return True
+        return False
+
+
+
+def _pointSegmentDistance(p, a, b):
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    lensq = dx * dx + dy * dy
+    if lensq == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / lensq
+    t = max(0.0, min(1.0, t))
+    return math.hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+# The minimum distance between segment p-q and segment a-b.
+def segmentDistance(p, q, a, b):
+    d1 = _cross(p, q, a)
+    d2 = _cross(p, q, b)
+    d3 = _cross(a, b, p)
+    d4 = _cross(a, b, q)
+    if ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0)) and d1 and d2 and d3 and d4:
+        return 0.0
+    return min(_pointSegmentDistance(p, a, b), _pointSegmentDistance(q, a, b),
+               _pointSegmentDistance(a, p, q), _pointSegmentDistance(b, p, q))
+
+
+# Even-odd test of whether point 'pt' is inside the area filled by 'lines'.
+# Each polyline is treated as closed, as SVG does when filling.
+def pointInPolylines(pt, lines):
+    (x, y) = pt
+    inside = False
+    for line in lines:
+        n = len(line)
+        for i in range(0, n):
+            (x1, y1) = line[i-1]
+            (x2, y2) = line[i]
+            if (y1 > y) != (y2 > y):
+                if x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+    return inside
+
+
+
 # A collection of methods for calculating centers of nodes. The only
 # method that should be called is 'compute()'; all the other methods are
 # private, support methods.
 class Centers:
 
-    def __init__(self, tmpdir):
+    VERSION = 3
+
+    # How often, in seconds, the centers found so far are written to the
+    # cache while they are being computed.
+    CHECKPOINT_SECS = 10
+
+    def __init__(self, tmpdir, rasterizer=None):
         self.tmpdir = tmpdir if tmpdir else 'tmp'
+        self.rasterizer = rasterizer if rasterizer else Rasterizer()
 
 
     def compute(self, svg, pngPrefix):
         astree = Astree(self._centersCacheFilename(pngPrefix))
         cachedCenters = astree.asDict()
 
-        centers = self._computeCenters(svg, cachedCenters, pngPrefix)
+        centers = self._computeCenters(svg, cachedCenters, pngPrefix, astree)
 
         astree.write(centers)
 
         return centers
 
 
-    def _computeCenters(self, svg, cachedCenters, pngPrefix):
+    # Nodes are computed in Options.jobs worker processes. Every
+    # CHECKPOINT_SECS, and if the computation is interrupted, the centers
+    # found so far are written to 'astree' (if given), so that they are not
+    # computed again.
+    def _computeCenters(self, svg, cachedCenters, pngPrefix, astree=None):
         centers = {}
-        togo = len(svg.dat.keys())
-
+        todo = []
         for nodeId in sorted(svg.dat.keys()):
-            if nodeId in cachedCenters:
-                centers[nodeId] = cachedCenters[nodeId]
-                continue
-            print('Processing {}    {}'.format(nodeId, togo))
             node = svg.getDatVal(nodeId)
-
-            img = convertSvgToImg(self._generateCenterSvg(node, svg.width, svg.height))
-
-            (x_pct, y_pct) = self._computeCenterPercent(img)
-
-            centers[nodeId] = { 'xc': x_pct,  'yc': y_pct }
-
-            if Options.save_center_png:
-                img.save(self._centersPngFilename(nodeId, pngPrefix))
-            togo -= 1
+            key = self._nodeKey(svg, node)
+            if nodeId in cachedCenters and cachedCenters[nodeId].get('hash') == key:
+                centers[nodeId] = cachedCenters[nodeId]
+            else:
+                todo.append((nodeId, key))
+
+        jobs = Options.getJobs()
+        if jobs > 1 and len(todo) > 1:
+            self._prepareMasks(svg, [nodeId for (nodeId, key) in todo])
+            pool = startWorkers(jobs, { 'centers': self, 'svg': svg, 'pngPrefix': pngPrefix })
+            results = pool.imap_unordered(_computeCenterWorker, todo)
+        else:
+            pool = None
+            results = (self._computeCenterEntry(svg, nodeId, key, pngPrefix) for (nodeId, key) in todo)
+
+        togo = len(todo)
+        lastCheckpoint = time.time()
+        try:
+            for (nodeId, entry) in results:
+                print('Processing {}    {}'.format(nodeId, togo))
+                centers[nodeId] = entry
+                togo -= 1
+                if astree and togo and time.time() - lastCheckpoint > self.CHECKPOINT_SECS:
+                    astree.write(centers)
+                    lastCheckpoint = time.time()
+        except BaseException:
+            if astree:
+                astree.write(centers)
+            raise
+        finally:
+            if pool:
+                pool.terminate()
 
         return centers;
 
 
-    def _generateCenterSvg(self, node, wid, hgt):
-        svgWidth = float(wid)
-        svgHeight = float(hgt)
+    # See Neighbors._prepareMasks().
+    def _prepareMasks(self, svg, nodeIds):
+        self.rasterizer.prepare(svg, nodeIds)
 
-        # Enlarging small SVG images gives more accurate results, but requires
-        # more processing time.
-        displayWidth = 1200.0 # Arbitrary
-        if svgWidth > displayWidth:
-            displayWidth = svgWidth
 
-        scale = svgWidth / displayWidth
-        scaledWid = svgWidth / scale
-        scaledHgt = svgHeight / scale
+    def _computeCenterEntry(self, svg, nodeId, key, pngPrefix):
+        (x_pct, y_pct) = self._computeCenterPercent(svg, nodeId, pngPrefix)
+        return (nodeId, { 'xc': x_pct,  'yc': y_pct, 'hash': key })
 
-        lines = [];
-        lines.append('<?xml version="1.0" encoding="UTF-8" ?>')
-        lines.append('<svg width="{}" height="{}" viewBox="0 0  {} {}" xmlns="http://www.w3.org/2000/svg">'.format( scaledWid, scaledHgt, svgWidth, svgHeight ))
-        lines.append('    <g>')
-        for path in node['paths']:
-            lines.append('        <path stroke-width="1" stroke="white" fill="white" d="{}" />'.format(path['d']))
-        lines.append('    </g>')
-        lines.append('</svg>')
-        return '\n'.join(lines)
 
+    # Returns the center of the node as fractions of the width and height of
+    # the node.
+    def _computeCenterPercent(self, svg, nodeId, pngPrefix):
+        mask = self._renderNode(svg, nodeId)
 
-    def _markCenterPoint(self, img, x, y, rad):
-        # Center
-        img.putpixel((x, y), Colors.RED)
+        (ctr_x, ctr_y, radius) = self._computeCenter(mask)
+        (hgt, wid) = mask.shape
 
-        # Make center point a bit larger
-        img.putpixel((x+1, y  ), Colors.RED)
-        img.putpixel((x-1, y  ), Colors.RED)
-        img.putpixel((x,   y+1), Colors.RED)
-        img.putpixel((x,   y-1), Colors.RED)
+        if Options.save_center_png:
+            img = maskToImage(mask)
+            self._markCenterPoint(img, ctr_x, ctr_y, radius)
+            img.save(self._centersPngFilename(nodeId, pngPrefix))
 
-        # Mark points on surrounding 'circle'
-        r = rad - 1
-        p = int(r / math.sqrt(2))
+        return (ctr_x/wid, ctr_y/hgt)
 
-        img.putpixel((x+r, y  ), Colors.RED)
-        img.putpixel((x-r, y  ), Colors.RED)
-        img.putpixel((x,   y+r), Colors.RED)
-        img.putpixel((x,   y-r), Colors.RED)
 
-        img.putpixel((x+p, y+p), Colors.RED)
-        img.putpixel((x+p, y-p), Colors.RED)
-        img.putpixel((x-p, y+p), Colors.RED)
-        img.putpixel((x-p, y-p), Colors.RED)
+    # Identifies how centers are computed, like Neighbors._engineKey().
+    def _engineKey(self, svg):
+        return 'raster-{} precision={} stroke={} base={!r}'.format(self.VERSION, Options.precision, STROKE_WIDTH, baseScale(svg.width))
 
 
-    # Find the radius of the largest circle (more accurately an 8-pointed star)
-    # where all points are white. This gives a cheap/fast approximation of the
-    # 'center' of a shape. This can return 'bad' (but valid) results when the
-    # shape is not solid (e.g. islands).
-    def _circle(self, im, x0, y0, maxr):
-        r = maxr
+    # Cached centers are only used if their 'hash' matches the current
+    # geometry of the node and the current settings.
+    def _nodeKey(self, svg, node):
+        return contentHash([nodeHash(node), self._engineKey(svg)])
 
 
-        while True:
-            if r > x0 or r > y0 or (x0 + r) >= im.width or (y0 + r) >= im.height:
-                r -= 1
-                break
+    # The node, rendered at the scale chosen for its own size. Returns a mask
+    # cropped to the node.
+    def _renderNode(self, svg, nodeId):
+        nodeMask = self.rasterizer.nodeMask(svg, nodeId)
+        if not nodeMask:
+            return np.zeros((1, 1), dtype=bool)
+        return nodeMask.mask
 
-            p = int(r / math.sqrt(2))
-            if (    im.getpixel( (x0+r, y0  ) ) == Colors.WHITE
-                and im.getpixel( (x0-r, y0  ) ) == Colors.WHITE
-                and im.getpixel( (x0,   y0+r) ) == Colors.WHITE
-                and im.getpixel( (x0,   y0-r) ) == Colors.WHITE
-
-                and im.getpixel( (x0+p, y0+p) ) == Colors.WHITE
-                and im.getpixel( (x0+p, y0-p) ) == Colors.WHITE
-                and im.getpixel( (x0-p, y0+p) ) == Colors.WHITE
-                and im.getpixel( (x0-p, y0-p) ) == Colors.WHITE
-                ):
-                r += 1
-            else:
-                break
-        return r
-
-    # A simple check to help ensure the center point is not a 'bad' location.
-    def _isSolidWhite(self, im, x0, y0, radius):
-        for r in range(1, radius):
-            if (   im.getpixel( (x0+r, y0  ) ) != Colors.WHITE
-                or im.getpixel( (x0-r, y0  ) ) != Colors.WHITE
-                or im.getpixel( (x0,   y0+r) ) != Colors.WHITE
-                or im.getpixel( (x0,   y0-r) ) != Colors.WHITE
-                ):
-                return False
-        return True
-
-    # If img contains clumps/islands of white pixels, they may affect the
-    # computed center point.
-    def _computeCenterPercent(self, img):
-        (wid, hgt) = img.size
-        center_point = None
-        max_radius = 1
-        for x in range(0, wid):
-            for y in range(0, hgt):
-                if img.getpixel((x, y)) == Colors.WHITE:
-                    radius = self._circle(img, x, y, max_radius)
-                    if radius > max_radius and self._isSolidWhite(img, x, y, radius):
-                        max_radius = radius
-                        center_point = (x, y)
-        if not center_point:
+
+    def _markCenterPoint(self, img, x, y, rad):
+        r = max(rad - 1, 1)
+        p = int(r / math.sqrt(2))
+        points = [
+            # Center, made a bit larger
+            (x, y), (x+1, y), (x-1, y), (x, y+1), (x, y-1),
+            # Points on surrounding 'circle'
+            (x+r, y), (x-r, y), (x, y+r), (x, y-r),
+            (x+p, y+p), (x+p, y-p), (x-p, y+p), (x-p, y-p),
+        ]
+        for (px, py) in points:
+            if 0 <= px < img.width and 0 <= py < img.height:
+                img.putpixel((px, py), Colors.RED)
+
+
+    # The center is the white pixel farthest from any black pixel (the 'pole
+    # of inaccessibility'), i.e. the center of the largest circle which fits
+    # in the shape. Pixels beyond the edge of the mask count as black. If the
+    # shape is not solid (e.g. islands), the center is in the largest piece.
+    # Returns (x, y, radius) in pixels.
+    def _computeCenter(self, mask):
+        (hgt, wid) = mask.shape
+        dist = distanceTransform(mask)
+        # Ties go to the smallest x, then the smallest y.
+        index = int(np.argmax(dist.T))
+        (ctr_x, ctr_y) = divmod(index, hgt)
+        if dist[ctr_y, ctr_x] == 0:
             print('No center point found. Using default')
-            center_point = (int(wid/2), int(hgt/2))
-        (ctr_x, ctr_y) = center_point
-        self._markCenterPoint(img, ctr_x, ctr_y, max_radius)
-        return ( ctr_x/wid, ctr_y/hgt )
+            return (int(wid/2), int(hgt/2), 1)
+        return (ctr_x, ctr_y, int(math.sqrt(dist[ctr_y, ctr_x])))
 
 
     def _centersPngFilename(self, nodeId, prefix):
@@ -522,18 +2116,81 @@ class Centers:
 
 
 
+def _computeCenterWorker(item):
+    (nodeId, key) = item
+    return WORKER['centers']._computeCenterEntry(WORKER['svg'], nodeId, key, WORKER['pngPrefix'])
+
+
+
+# Computes centers from the geometry of the paths, without rendering
+# anything. The center is the 'pole of inaccessibility' (the point farthest
+# from the outline) found by the polylabel algorithm: the bounding box is
+# split into square cells, and cells which might contain a better point than
+# the best found so far are split again, until the center is known to within
+# 'precision' SVG units.
+class VectorCenters(Centers):
+
+    VERSION = 2
+
+    # Without a precision, centers are found to within 1/SIZE_DIVISOR of the
+    # larger side of each node.
+    SIZE_DIVISOR = 300
+
+    # Curves are flattened to FLATTEN_FACTOR times the precision. Flattening
+    # more finely makes little difference to where centers are found, but
+    # gives polylabel() more segments to measure.
+    FLATTEN_FACTOR = 2
+
+    def __init__(self, tmpdir, precision=None, rasterizer=None):
+        super().__init__(tmpdir, rasterizer)
+        # None means 1/SIZE_DIVISOR of the larger side of each node.
+        self.precision = precision
+
+
+    def _engineKey(self, svg):
+        return 'vector-{} precision={}'.format(self.VERSION, self.precision)
+
+
+    def _prepareMasks(self, svg, nodeIds):
+        pass
+
+
+    def _computeCenterPercent(self, svg, nodeId, pngPrefix):
+        box = self.rasterizer.nodeBbox(svg, nodeId)
+        if not box:
+            return (0.5, 0.5)
+        (x0, y0, x1, y1) = box
+        size = max(x1 - x0, y1 - y0)
+        precision = self.precision if self.precision else size / self.SIZE_DIVISOR
+        lines = self.rasterizer.nodePolylines(svg, nodeId, precision * self.FLATTEN_FACTOR)
+        (cx, cy) = polylabel(lines, box, precision)
+        return ((cx - x0) / max(x1 - x0, 1e-9), (cy - y0) / max(y1 - y0, 1e-9))
+
+
+
 class Tour:
 
     def __init__(self, astFilename, tmpdir='tmp'):
         self.name = self._basename(astFilename)
         self.ast = Astree(astFilename)
-        self.svg = Svg(self._getSvgFilename(), self.ast.getNodes())
+        self.svg = Svg(self._getSvgFilename(), self.ast.getNodes(), self.ast.getExtra())
 
         self.tmpdir = tmpdir
         self.neighbors = None
         self.centers = None
         self._mkDir(tmpdir)
 
+        # Renders each node once for both neighbors and centers, and keeps the
+        # renders for later builds. Shards, which may run at the same time,
+        # only read them. Only the raster engines use renders.
+        store = None
+        engines = [Options.neighbor_engine or self.ast.getNeighborEngine(), Options.center_engine or self.ast.getCenterEngine()]
+        if 'raster' in engines:
+            store = MaskStore(os.path.join(tmpdir, '{}_masks.index'.format(self.name)), not Options.shard)
+        self.rasterizer = Rasterizer(store)
+        self._decimals = None
+        self._lods = None
+
 
     def _getSvgFilename(self):
         val = self.ast.getSvgname()
@@ -567,17 +2224,157 @@ class Tour:
         lines = []
         lines.append('<svg width="{0}" height="{1}" id="svgimg" viewBox="0 0  {0} {1}" xmlns="http://www.w3.org/2000/svg">'.format(self.svg.width, self.svg.height))
         lines.extend(self._populateExtraSvgDat())
+        levels = self._lodPaths()
         for nodeId in self.svg.getDatKeys():
             node = self.svg.getDatVal(nodeId)
             lines.append('    <g id="g_{0}" class="g_{0}">'.format(node['nodeId']))
             lines.append('        <title>{}</title>'.format(node['name']))
-            for path in node['paths']:
-                lines.append('        <path id="{}" class="lander {}" d="{}" />'.format(path['pathId'], node['nodeId'], path['d']))
+            for (i, path) in enumerate(node['paths']):
+                # With a topology, the path data is filled in when the page is
+                # loaded.
+                d = '' if Options.topology else levels[0][(nodeId, i)]
+                lines.append('        <path id="{}" class="lander {}" d="{}" />'.format(path['pathId'], node['nodeId'], d))
             lines.append('    </g>')
         lines.append('</svg>')
         return '\n'.join(lines)
 
 
+    def _outputPathData(self, d):
+        if not Options.compact_paths:
+            return d
+        return PathData(d).compact(self._pathDecimals())
+
+
+    # The path data of each path of each node, keyed by (nodeId, index of
+    # the path).
+    def _nodePaths(self):
+        paths = {}
+        for nodeId in self.svg.getDatKeys():
+            for (i, path) in enumerate(self.svg.getDatVal(nodeId)['paths']):
+                paths[(nodeId, i)] = path['d']
+        return paths
+
+
+    # The path data of each path of each node, as written to the HTML, keyed
+    # by (nodeId, index of the path). Simplified if Options.simplify is set.
+    def _outputPaths(self, tolerance=None):
+        paths = self._nodePaths()
+        tolerance = tolerance or Options.simplify
+        if tolerance:
+            # Simplified paths are already compact, so they are rounded once,
+            # to the decimal places of compact paths if those are wanted.
+            simplifier = PathSimplifier(tolerance)
+            paths = simplifier.simplify(paths, self._pathDecimals() if Options.compact_paths else None)
+            print('Simplified paths (tolerance {:g}) from {} to {} points'.format(tolerance, simplifier.before, simplifier.after))
+            return paths
+        for (key, d) in paths.items():
+            paths[key] = self._outputPathData(d)
+        return paths
+
+
+    # The tolerances of the levels of detail, coarsest first, with None for
+    # the full detail. The coarsest level is accurate to about a pixel when
+    # the whole map is shown on a display DISPLAY_WIDTH pixels wide, and each
+    # level is four times finer than the one before. Levels which would be
+    # finer than Options.simplify are left out.
+    def _lodTolerances(self):
+        coarsest = max(self.svg.width, self.svg.height) / self.DISPLAY_WIDTH
+        tolerances = [coarsest / 4**i for i in range(0, Options.lod_levels - 1)]
+        return [tol for tol in tolerances if tol > (Options.simplify or 0)] + [None]
+
+
+    # The paths of each node as a topology (see Topology): arcs are stored
+    # once, as integer multiples of 10**-decimals, each point as the offset
+    # from the previous one (the first from (0, 0)). Each outline is a list
+    # of 1 (closed) or 0 (open) followed by its arc references. The paths are
+    # simplified to 'tolerance', Options.simplify, or a pixel at the expected
+    # zoom.
+    def _outputTopology(self, tolerance=None):
+        tolerance = tolerance or Options.simplify or self._pathPixel()
+        simplifier = PathSimplifier(tolerance)
+        (topology, arcs) = simplifier.simplifyTopology(self._nodePaths())
+        decimals = self._pathDecimals()
+        encoded = []
+        for arc in arcs:
+            ints = np.rint(np.array(arc, dtype=float) * 10 ** decimals).astype(np.int64)
+            deltas = np.diff(ints, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+            # Points which round onto the previous one are dropped, but not
+            # the end points, which join the arc to the next one.
+            keep = np.any(deltas != 0, axis=1)
+            keep[0] = keep[-1] = True
+            encoded.append(np.diff(ints[keep], axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel().tolist())
+        outlines = {}
+        for (key, keyOutlines) in topology.outlines.items():
+            outlines[key] = [[1 if closed else 0] + refs for (closed, refs) in keyOutlines]
+        print('Simplified paths (tolerance {:g}) from {} to {} points, in {} arcs'.format(tolerance, simplifier.before, simplifier.after, len(arcs)))
+        return { 'decimals': decimals, 'arcs': encoded, 'outlines': outlines }
+
+
+    # The output paths of each level of detail, coarsest first. Topologies
+    # instead of path data if Options.topology is set.
+    def _lodPaths(self):
+        if self._lods is None:
+            output = self._outputTopology if Options.topology else self._outputPaths
+            self._lods = [output(tol) for tol in self._lodTolerances()]
+        return self._lods
+
+
+    # The levels of detail, for the Javascript: the tolerance of each level
+    # (0 for the full detail) and the path data of every 'lander' path at
+    # each level, in the order they appear in the SVG. With Options.topology,
+    # each level is a topology instead, which the Javascript turns into path
+    # data when the page is loaded.
+    def jsLod(self):
+        levels = self._lodPaths()
+        if len(levels) < 2 and not Options.topology:
+            return 'null'
+        order = [(nodeId, i) for nodeId in self.svg.getDatKeys() for i in range(0, len(self.svg.getDatVal(nodeId)['paths']))]
+        lines = []
+        lines.append('{')
+        lines.append("  'tolerances': {},".format(json.dumps([tol or 0 for tol in self._lodTolerances()])))
+        if Options.topology:
+            lines.append("  'topologies': [")
+            for topology in levels:
+                lines.append('    {')
+                lines.append("      'decimals': {},".format(topology['decimals']))
+                lines.append("      'arcs': {},".format(json.dumps(topology['arcs'], separators=(',', ':'))))
+                lines.append("      'outlines': {},".format(json.dumps([topology['outlines'][key] for key in order], separators=(',', ':'))))
+                lines.append('    },')
+            lines.append('  ],')
+        else:
+            lines.append("  'paths': [")
+            for paths in levels:
+                lines.append('    {},'.format(json.dumps([paths[key] for key in order])))
+            lines.append('  ],')
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+    # The number of decimal places needed for coordinates to be accurate to
+    # a pixel at the expected zoom. The map is expected to be viewed on a
+    # display about DISPLAY_WIDTH pixels wide, zoomed in as far as when the
+    # smallest node is the target (see computeEndBox() in the Javascript),
+    # unless Options.path_zoom is set.
+    DISPLAY_WIDTH = 1200.0
+
+    def _pathDecimals(self):
+        if self._decimals is None:
+            self._decimals = max(0, int(math.ceil(-math.log10(self._pathPixel()))))
+            print('Writing path data with {} decimal places'.format(self._decimals))
+        return self._decimals
+
+
+    # The size, in SVG units, of a pixel at the expected zoom.
+    def _pathPixel(self):
+        size = max(self.svg.width, self.svg.height)
+        zoom = Options.path_zoom
+        if not zoom:
+            boxes = [self.rasterizer.nodeBbox(self.svg, nodeId) for nodeId in self.svg.getDatKeys()]
+            sizes = [max(b[2] - b[0], b[3] - b[1]) for b in boxes if b]
+            zoom = size / (1.6 * min(sizes)) if sizes and min(sizes) > 0 else 1.0
+        return size / (zoom * self.DISPLAY_WIDTH)
+
+
     def _populateExtraSvgDat(self):
         lines = []
 
@@ -587,7 +2384,8 @@ class Tour:
                 child = children[0]
                 ln = ['<path']
                 for key in child.keys():
-                    prop = '{}="{}"'.format(key, child.attrib[key])
+                    val = self._outputPathData(child.attrib[key]) if key == 'd' else child.attrib[key]
+                    prop = '{}="{}"'.format(key, val)
                     ln.append(prop)
                 ln.append('/>\n')
                 lines.append(' '.join(ln))
@@ -596,15 +2394,53 @@ class Tour:
         return lines
 
 
+    def _newNeighbors(self):
+        engine = Options.neighbor_engine or self.ast.getNeighborEngine()
+        tolerance = Options.tolerance if Options.tolerance is not None else self.ast.getTolerance()
+        if engine == 'vector':
+            return VectorNeighbors(self.tmpdir, tolerance, self.rasterizer)
+        if engine != 'raster':
+            raise Exception('Unknown neighbor engine: {}'.format(engine))
+        return Neighbors(self.tmpdir, self.rasterizer)
+
+
     def getNeighbors(self):
         if not self.neighbors:
-            self.neighbors = Neighbors(self.tmpdir).compute(self.svg, self.ast.getJoin(), self.ast.getSnip(), self.name)
+            self.neighbors = self._newNeighbors().compute(self.svg, self.ast.getJoin(), self.ast.getSnip(), self.name)
         return self.neighbors
 
 
+    def computeShard(self):
+        self._newNeighbors().computeShard(self.svg, self.name, Options.shard)
+
+
+    def mergeShards(self):
+        self._newNeighbors().mergeShards(self.name, Options.merge_shards)
+
+
+    def _newCenters(self):
+        engine = Options.center_engine or self.ast.getCenterEngine()
+        if engine == 'vector':
+            precision = Options.center_precision if Options.center_precision is not None else self.ast.getCenterPrecision()
+            return VectorCenters(self.tmpdir, precision, self.rasterizer)
+        if engine != 'raster':
+            raise Exception('Unknown center engine: {}'.format(engine))
+        return Centers(self.tmpdir, self.rasterizer)
+
+
+    # Writes the renders kept for later builds, once the neighbors and
+    # centers have been computed.
+    def flushMasks(self):
+        self.rasterizer.flush(self.svg)
+
+
+    # The 'hash' of each center is only used for caching.
     def getCenters(self):
         if not self.centers:
-            self.centers = Centers(self.tmpdir).compute(self.svg, self.name)
+            centers = self._newCenters().compute(self.svg, self.name)
+            self.centers = {}
+            for (nodeId, center) in centers.items():
+                self.centers[nodeId] = { 'xc': center['xc'], 'yc': center['yc'] }
         return self.centers
 
 
@@ -688,17 +2524,281 @@ class Tour:
         return '\n'.join(sorted(lines))
 
 
-# Accepts SVG as string, returns an Image.
-# The SVG is converted to a PNG, the PNG is cropped as closely as possible
-# (i.e. as much of the background is removed as possible), and then converted
-# to a black-and-white image that has an RGB color-space.
-def convertSvgToImg(svgstr):
-    output = svg2png(bytestring=svgstr.encode('utf-8'))
-    im = Image.open(io.BytesIO(output))
-    im2 = im.crop(im.getbbox())
-    im3 = im2.convert('1') # Convert to black and white, so background is black, not transparent
-    im4 = im3.convert("RGB")
-    return im4
+# Width of the stroke drawn around each path when rendering, in SVG units.
+# It closes small gaps between paths which are meant to touch.
+STROKE_WIDTH = 1.0
+
+
+# Vertices closer than this (in SVG units) are considered the same vertex.
+VERTEX_QUANTUM = 0.01
+
+
+# The coarsest rendering scale, in pixels per SVG unit. The whole SVG would be
+# at least 1200 pixels wide.
+def baseScale(svgWidth):
+    displayWidth = 1200.0 # Arbitrary
+    if svgWidth > displayWidth:
+        displayWidth = svgWidth
+    return displayWidth / svgWidth
+
+
+# Chooses the scale, in pixels per SVG unit, at which to render the area
+# 'box' so that its longer side is about Options.precision pixels. Enlarging
+# small areas gives more accurate results, but requires more processing time.
+# The scale is never coarser than baseScale(), and it is always a power of two
+# times baseScale() so that renders of nearby areas are likely to share it.
+def windowScale(svgWidth, box):
+    base = baseScale(svgWidth)
+    size = max(box[2] - box[0], box[3] - box[1], 1e-6)
+    level = int(math.floor(math.log2(max(Options.precision / (size * base), 1.0))))
+    return base * (2 ** min(level, 8))
+
+
+def nodeBbox(node):
+    boxes = [PathData(path['d']).bbox() for path in node['paths']]
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return None
+    return (min([b[0] for b in boxes]), min([b[1] for b in boxes]),
+            max([b[2] for b in boxes]), max([b[3] for b in boxes]))
+
+
+# The vertex at 'point', as integer multiples of VERTEX_QUANTUM.
+def vertexKey(point):
+    return (int(round(point[0] / VERTEX_QUANTUM)), int(round(point[1] / VERTEX_QUANTUM)))
+
+
+# A short hash of a list of strings.
+def contentHash(strs):
+    sha = hashlib.sha1()
+    for st in strs:
+        sha.update(st.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()[:16]
+
+
+# A hash of the geometry of a node. The NodeId, name and SvgIds do not matter.
+def nodeHash(node):
+    return contentHash([path['d'] for path in node['paths']])
+
+
+# Returns the squared Euclidean distance from each pixel of 'mask' to the
+# nearest False pixel. Pixels beyond the edge of the mask count as False.
+# The distance is found along each column, then combined along each row
+# (d(x)^2 = min over k of k^2 + g(x+k)^2), stopping once k^2 exceeds every
+# remaining distance.
+def distanceTransform(mask):
+    (hgt, wid) = mask.shape
+    padded = np.zeros((hgt + 2, wid + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+
+    big = hgt + wid + 4
+    g = np.where(padded, big, 0).astype(np.int64)
+    for y in range(1, hgt + 2):
+        g[y] = np.minimum(g[y], g[y-1] + 1)
+    for y in range(hgt, -1, -1):
+        g[y] = np.minimum(g[y], g[y+1] + 1)
+
+    g2 = g * g
+    dist = g2.copy()
+    k = 1
+    while k < wid + 2 and k * k < dist.max():
+        dist[:, :-k] = np.minimum(dist[:, :-k], g2[:, k:] + k * k)
+        dist[:, k:] = np.minimum(dist[:, k:], g2[:, :-k] + k * k)
+        k += 1
+    return dist[1:-1, 1:-1]
+
+
+# The signed distances from points (xs, ys) to the outline of the area
+# filled (even-odd) by the closed rings whose edges are 'segs', an array of
+# rows (ax, ay, bx, by). Positive inside, negative outside.
+def signedDistances(segs, xs, ys):
+    (ax, ay, bx, by) = (segs[:, 0], segs[:, 1], segs[:, 2], segs[:, 3])
+    (dx, dy) = (bx - ax, by - ay)
+    lensq = np.where(dx * dx + dy * dy == 0, 1.0, dx * dx + dy * dy)
+    px = xs[:, None] - ax
+    py = ys[:, None] - ay
+    t = np.clip((px * dx + py * dy) / lensq, 0.0, 1.0)
+    dist = np.sqrt(((px - t * dx) ** 2 + (py - t * dy) ** 2).min(axis=1))
+    crosses = (ay > ys[:, None]) != (by > ys[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xint = ax + (ys[:, None] - ay) * dx / np.where(dy == 0, 1.0, dy)
+    inside = (crosses & (xs[:, None] < xint)).sum(axis=1) % 2 == 1
+    return np.where(inside, dist, -dist)
+
+
+# signedDistances() of the points a chunk at a time, to bound the size of the
+# (points x segments) arrays.
+def chunkedSignedDistances(segs, xs, ys):
+    chunk = max(1, 2000000 // len(segs))
+    return np.concatenate([signedDistances(segs, xs[i:i+chunk], ys[i:i+chunk]) for i in range(0, len(xs), chunk)])
+
+
+# Finds the point within 'precision' of the point farthest inside the area
+# filled by 'lines', the polylines of one node, whose bounding box is 'box'.
+# This is the polylabel algorithm, except that all cells of the same size are
+# evaluated at once: every round, cells which cannot contain a point better
+# than the best so far (by more than 'precision') are dropped, and the rest
+# are split in four.
+def polylabel(lines, box, precision):
+    segs = []
+    for line in lines:
+        for i in range(0, len(line)):
+            segs.append((line[i-1][0], line[i-1][1], line[i][0], line[i][1]))
+    (x0, y0, x1, y1) = box
+    cellSize = min(x1 - x0, y1 - y0)
+    if not segs or cellSize <= 0:
+        return ((x0 + x1) / 2, (y0 + y1) / 2)
+    segs = np.array(segs, dtype=float)
+
+    half = cellSize / 2
+    (xs, ys) = np.meshgrid(np.arange(x0, x1, cellSize) + half, np.arange(y0, y1, cellSize) + half)
+    (xs, ys) = (xs.ravel(), ys.ravel())
+    bestX = (x0 + x1) / 2
+    bestY = (y0 + y1) / 2
+    bestD = chunkedSignedDistances(segs, np.array([bestX]), np.array([bestY]))[0]
+    while len(xs) and half > 0:
+        dists = chunkedSignedDistances(segs, xs, ys)
+        i = np.argmax(dists)
+        if dists[i] > bestD:
+            (bestX, bestY, bestD) = (xs[i], ys[i], dists[i])
+        keep = dists + half * math.sqrt(2) - bestD > precision
+        (xs, ys) = (xs[keep], ys[keep])
+        half /= 2
+        xs = np.concatenate([xs - half, xs + half, xs - half, xs + half])
+        ys = np.concatenate([ys - half, ys - half, ys + half, ys + half])
+    return (float(bestX), float(bestY))
+
+
+# The distances from each of 'points' (an array of rows (x, y)) to the
+# segment from 'a' to 'b'.
+def segmentDistances(points, a, b):
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    lensq = dx * dx + dy * dy
+    if lensq == 0:
+        return np.hypot(points[:, 0] - a[0], points[:, 1] - a[1])
+    t = np.clip(((points[:, 0] - a[0]) * dx + (points[:, 1] - a[1]) * dy) / lensq, 0.0, 1.0)
+    return np.hypot(points[:, 0] - (a[0] + t * dx), points[:, 1] - (a[1] + t * dy))
+
+
+# Douglas-Peucker simplification of a polyline: returns the indexes of the
+# points to keep, so that no point is further than 'tolerance' from the
+# simplified line. The end points are always kept.
+def douglasPeucker(points, tolerance):
+    arr = np.array(points, dtype=float)
+    keep = np.zeros(len(arr), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(arr) - 1)]
+    while stack:
+        (i, j) = stack.pop()
+        if j - i < 2:
+            continue
+        dists = segmentDistances(arr[i+1:j], arr[i], arr[j])
+        k = int(np.argmax(dists))
+        if dists[k] > tolerance:
+            keep[i + 1 + k] = True
+            stack.append((i, i + 1 + k))
+            stack.append((i + 1 + k, j))
+    return [int(i) for i in np.flatnonzero(keep)]
+
+
+def unionBbox(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+# Renders 'nodes' within the area 'box' (grown by the stroke and a pixel) at
+# 'scale' pixels per SVG unit. The area is aligned to whole pixels, so pixel
+# (x, y) covers SVG coordinates (x/scale, y/scale) for every render at the
+# same scale. Returns (x, y, mask) like convertSvgToMask(), with (x, y) on that
+# shared pixel grid, or None if nothing was drawn.
+def renderWindowMask(nodes, box, scale):
+    margin = STROKE_WIDTH + 1 / scale
+    px0 = int(math.floor((box[0] - margin) * scale))
+    py0 = int(math.floor((box[1] - margin) * scale))
+    px1 = int(math.ceil((box[2] + margin) * scale))
+    py1 = int(math.ceil((box[3] + margin) * scale))
+
+    lines = []
+    lines.append('<?xml version="1.0" encoding="UTF-8"?>')
+    lines.append('<svg width="{}" height="{}" viewBox="{} {} {} {}" xmlns="http://www.w3.org/2000/svg">'.format(
+        px1 - px0, py1 - py0, px0 / scale, py0 / scale, (px1 - px0) / scale, (py1 - py0) / scale))
+    for node in nodes:
+        lines.append('    <g>')
+        for path in node['paths']:
+            lines.append('        <path stroke-width="{}" stroke="white" fill="white" d="{}" />'.format(STROKE_WIDTH, path['d']))
+        lines.append('    </g>')
+    lines.append('</svg>\n')
+
+    result = convertSvgToMask('\n'.join(lines))
+    if not result:
+        return None
+    (x, y, mask) = result
+    return (px0 + x, py0 + y, mask)
+
+
+
+# Rendering straight into memory relies on internals of cairosvg 2 (the 'Tree'
+# parser, and overriding PNGSurface._create_surface()). If they are missing or
+# have changed, SVG is rendered with the public svg2png() instead, and the PNG
+# is decoded.
+try:
+    from cairosvg.parser import Tree
+    from cairosvg.surface import PNGSurface
+    import cairocffi
+
+    # A cairosvg surface which renders into an 8-bit, alpha-only image in
+    # memory, instead of encoding a PNG.
+    class MaskSurface(PNGSurface):
+
+        def _create_surface(self, width, height):
+            width = int(round(width))
+            height = int(round(height))
+            return (cairocffi.ImageSurface(cairocffi.FORMAT_A8, width, height), width, height)
+except ImportError:
+    MaskSurface = None
+
+
+# Returns a 2-D boolean array (rows, columns) which is True wherever the SVG
+# draws anything. Rendered straight into an alpha-only buffer, if possible
+# (see MaskSurface). The buffer belongs to the surface, and is freed with it,
+# so it is thresholded into a new array while the surface is still alive.
+def renderSvgMask(svgstr):
+    global MaskSurface
+    if MaskSurface is not None:
+        try:
+            surface = MaskSurface(Tree(bytestring=svgstr.encode('utf-8')), None, 96)
+            image = surface.cairo
+            image.flush()
+            (wid, hgt) = (image.get_width(), image.get_height())
+            # Rows of the buffer may be padded beyond the width of the image.
+            mask = np.frombuffer(image.get_data(), dtype=np.uint8).reshape(hgt, image.get_stride())[:, :wid] > 0
+            del image, surface
+            return mask
+        except (AttributeError, TypeError) as exc:
+            print('Rendering with svg2png(), as cairosvg internals have changed ({})'.format(exc))
+            MaskSurface = None
+    png = cairosvg.svg2png(bytestring=svgstr.encode('utf-8'))
+    return np.asarray(Image.open(io.BytesIO(png)).convert('RGBA').getchannel('A')) > 0
+
+
+# Accepts SVG as string, returns (x, y, mask).
+# The SVG is rendered (see renderSvgMask()) into a 2-D boolean
+# array (rows, columns) which is True wherever anything was drawn. The array
+# is cropped as closely as possible (i.e. as much of the background is
+# removed as possible), and (x, y) is the position of the cropped mask within
+# the rendered image. Returns None if nothing was drawn.
+def convertSvgToMask(svgstr):
+    mask = renderSvgMask(svgstr)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return None
+    (x0, y0) = (int(cols[0]), int(rows[0]))
+    return (x0, y0, mask[y0:rows[-1]+1, x0:cols[-1]+1])
+
+
+def maskToImage(mask):
+    return Image.fromarray(mask).convert('RGB')
 
 
 
@@ -1208,6 +3308,83 @@ function getViewbox() {
 function setViewbox(x, y, w, h) {
     var svgimg = document.querySelector('#svgimg');
     svgimg.setAttribute('viewBox', x + ' ' + y + ' '+ w + ' ' + h);
+    updateLod();
+}
+
+// Switches to a finer level of detail as soon as the current one is off by
+// more than one and a half pixels, but back to a coarser one only once that
+// one would be off by a pixel or less, so that small changes of zoom do not
+// keep switching levels.
+var lodLevel = 0;
+function updateLod() {
+    if (!lod) {
+        return;
+    }
+    var vb = getViewbox();
+    var rect = getSvgRect();
+    var unitsPerPixel = Math.max(vb.width / rect.width, vb.height / rect.height);
+    var level = lodLevel;
+    while (level < lod.paths.length - 1 && lod.tolerances[level] > 1.5 * unitsPerPixel) {
+        level++;
+    }
+    while (level > 0 && lod.tolerances[level - 1] <= unitsPerPixel) {
+        level--;
+    }
+    if (level != lodLevel) {
+        lodLevel = level;
+        setLodPaths(level);
+    }
+}
+
+function setLodPaths(level) {
+    var paths = document.querySelectorAll('#svgimg path.lander');
+    for (var i = 0; i < paths.length; i++) {
+        paths[i].setAttribute('d', lod.paths[level][i]);
+    }
+}
+
+// Rebuilds the path data of every 'lander' path from a topology. (See
+// Tour._outputTopology().)
+function topologyToPaths(topology) {
+    var scale = Math.pow(10, topology.decimals);
+    var arcs = topology.arcs.map(function(deltas) {
+        var pts = [];
+        var x = 0;
+        var y = 0;
+        for (var i = 0; i < deltas.length; i += 2) {
+            x += deltas[i];
+            y += deltas[i+1];
+            pts.push((x / scale) + ' ' + (y / scale));
+        }
+        return pts;
+    });
+    return topology.outlines.map(function(outlines) {
+        var parts = [];
+        outlines.forEach(function(outline) {
+            var pts = [];
+            for (var i = 1; i < outline.length; i++) {
+                var ref = outline[i];
+                var arc = (ref >= 0 ? arcs[ref] : arcs[~ref].slice().reverse());
+                pts = pts.concat(pts.length ? arc.slice(1) : arc);
+            }
+            if (outline[0]) {
+                pts.pop();
+            }
+            parts.push('M' + pts.join('L') + (outline[0] ? 'Z' : ''));
+        });
+        return parts.join('');
+    });
+}
+
+function initLod() {
+    if (!lod) {
+        return;
+    }
+    if (lod.topologies) {
+        lod.paths = lod.topologies.map(topologyToPaths);
+        setLodPaths(lodLevel);
+    }
+    updateLod();
 }
 
 function getBoundingBoxOfElement(gcc) {
@@ -1805,6 +3982,7 @@ function init() {
         config = getDefaultConfig();
     }
     parseQueryString(location.search);
+    initLod();
     start();
 }
 
@@ -1926,6 +4104,8 @@ def generateHtml(tour):
     lines.append('')
     lines.append("var centers = "+prettyPrint(tour.getCenters())+';')
     lines.append('')
+    lines.append('var lod = '+tour.jsLod()+';')
+    lines.append('')
     lines.append(jsCode())
     lines.append('</script>')
 
@@ -2030,16 +4210,69 @@ def generateHtml(tour):
     return '\n'.join(lines)
 
 
-def main():
-    astFilename = 'default.ast'
-    if len(sys.argv) > 1:
-        astFilename = sys.argv[1]
+# Parses 'K/N' into (K, N).
+def parseShard(text):
+    try:
+        (k, n) = [int(val) for val in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected K/N, not {}'.format(text))
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError('expected 1 <= K <= N, not {}'.format(text))
+    return (k, n)
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description='Generate an HTML file from an AST file and an SVG file.')
+    parser.add_argument('ast', nargs='?', default='default.ast', help='The AST file to read')
+    parser.add_argument('--neighbor-engine', choices=['raster', 'vector'], help="How neighbors are detected. Overrides 'neighborengine' in the AST file. (default: raster)")
+    parser.add_argument('--tolerance', type=float, help="Distance, in SVG units, within which the vector engine considers nodes to be neighbors. Overrides 'tolerance' in the AST file. (default: 1.5)")
+    parser.add_argument('--center-engine', choices=['raster', 'vector'], help="How centers are computed. Overrides 'centerengine' in the AST file. (default: raster)")
+    parser.add_argument('--center-precision', type=float, help="Precision, in SVG units, of centers computed by the vector engine. Overrides 'centerprecision' in the AST file. (default: 1/300 of the size of each node)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes used to compute neighbors and centers. 0 means one per CPU. (default: 1)')
+    parser.add_argument('--compact-paths', action='store_true', help='Write path data with short relative commands and coordinates rounded to the precision needed at the expected zoom.')
+    parser.add_argument('--path-zoom', type=float, help='The expected maximum zoom, used with --compact-paths. (default: zoomed in on the smallest node)')
+    parser.add_argument('--simplify', type=float, metavar='TOLERANCE', help='Simplify the paths of nodes in the HTML so that no point moves more than TOLERANCE SVG units. Borders shared by nodes stay shared.')
+    parser.add_argument('--lod-levels', type=int, default=0, metavar='N', help='Embed N levels of detail of the paths of nodes, from about a pixel of the whole map down to full detail, and switch between them while zooming. (default: disabled)')
+    parser.add_argument('--topology', action='store_true', help='Write the paths of nodes as arcs, each border shared by two nodes stored once, and rebuild the paths when the page is loaded. Paths are simplified to --simplify, or to a pixel at the expected zoom (see --path-zoom).')
+    parser.add_argument('--shard', type=parseShard, metavar='K/N', help='Only check the pairs of nodes of shard K of N (from 1/N to N/N), and write the results to a shard file in tmp/, instead of building the HTML. Shards can run at the same time, on one machine or several.')
+    parser.add_argument('--merge-shards', type=int, metavar='N', help='Add the results of shards 1/N to N/N (see --shard) to the cache, then build the HTML.')
+    parser.add_argument('--precision', type=int, default=Options.precision, help='Approximate size, in pixels, at which nodes are rendered to compute neighbors and centers. Higher is more accurate but slower. (default: {})'.format(Options.precision))
+    parser.add_argument('--shared-vertices', type=int, default=Options.shared_vertices, help='Nodes sharing at least this many vertices are neighbors without further checks. 0 disables this. (default: {})'.format(Options.shared_vertices))
+    args = parser.parse_args(argv)
+    Options.precision = args.precision
+    Options.shared_vertices = args.shared_vertices
+    Options.neighbor_engine = args.neighbor_engine
+    Options.tolerance = args.tolerance
+    Options.center_engine = args.center_engine
+    Options.center_precision = args.center_precision
+    Options.jobs = args.jobs
+    Options.compact_paths = args.compact_paths
+    Options.path_zoom = args.path_zoom
+    Options.simplify = args.simplify
+    Options.lod_levels = args.lod_levels
+    Options.topology = args.topology
+    Options.shard = args.shard
+    Options.merge_shards = args.merge_shards
+    return args
+
+
+# 'argv' defaults to the command line.
+def main(argv=None):
+    args = parseArgs(argv)
+    astFilename = args.ast
     print('Reading AST '+astFilename)
     tour = Tour(astFilename)
+    if Options.shard:
+        tour.computeShard()
+        return
+    if Options.merge_shards:
+        tour.mergeShards()
     html = generateHtml(tour)
+    tour.flushMasks()
 
     fil = open(tour.getName()+'.html', 'w')
     fil.write(html)
     fil.close()
 
-main()
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,8 @@ set -e
 rm -f world-map.html
 rm -f world-map.ast
 
-if [ ! -f world-map.ast ]; then
-    FILES='_world_africa.ast _world_asia.ast _world_europe.ast _world_isle.ast _world_namer.ast _world_samer.ast'
-    for fil in $FILES
-    do
-        python3 ../visitour.py $fil    # Generate *_neighbors and *_centers (and *.html) files.
-    done
-
-    python3 merge-ast.py -c _connect.ast $FILES    # Generate world-map.ast
-fi
-
-python3 ../visitour.py world-map.ast
+# Generate world-map.ast and build it. Neighbors are computed for the whole
+# map at once, a tile of nearby nodes at a time, so borders between regions
+# are found too.
+FILES='_world_africa.ast _world_asia.ast _world_europe.ast _world_isle.ast _world_namer.ast _world_samer.ast'
+python3 merge-ast.py -b -c _connect.ast $FILES -- --jobs 0
@@ -1,10 +1,17 @@
-# Merges AST files and writes merged data to a new file. (WARNING: Also deletes
-# all HTML files in the current directory.)
+# Merges AST files and writes merged data to a new file. Cache files of the
+# input AST files, if any, are merged too. (WARNING: Also deletes all HTML
+# files in the current directory.)
 #
-# Usage: python3 merge-ast.py [-c _connect.ast] _file1.ast _file2.ast ... _fileN.ast
+# Usage: python3 merge-ast.py [-b] [-c _connect.ast] _file1.ast _file2.ast ... _fileN.ast [-- options]
 #
 #        The '-c' parameter currently has no special behavior.
 #
+#        With '-b', the merged AST file is then built in the same process, as
+#        'python3 ../visitour.py merged.ast options' would, without building
+#        the input AST files first. The SVG file is parsed once, and the
+#        neighbors and centers of the whole map are computed together (see
+#        '--jobs'), using the cache files of the input AST files, if any.
+#
 # Input AST files can be named anything. The underscore prefix and the '.ast'
 # extension is only a convention.
 #
@@ -19,6 +26,8 @@ import os
 AST_DATA = {
     'connector': None,
     'fragments': [],
+    'build': False,
+    'options': [],
 }
 
 
@@ -44,10 +53,33 @@ def addFragment(fnam):
     AST_DATA['fragments'].append(fnam)
 
 
+def getBuild():
+    return AST_DATA['build']
+
+
+def getBuildOptions():
+    return AST_DATA['options']
+
+
+def setBuild(options):
+    global AST_DATA
+    AST_DATA['build'] = True
+    AST_DATA['options'] = options
+
+
 def parseArgs():
     cparm = False
-    if len(sys.argv) > 3:
-        for arg in sys.argv[1:]:
+    args = sys.argv[1:]
+    if '--' in args:
+        options = args[args.index('--')+1:]
+        args = args[:args.index('--')]
+    else:
+        options = []
+    if '-b' in args:
+        setBuild(options)
+        args = [arg for arg in args if arg != '-b']
+    if len(args) > 2:
+        for arg in args:
             if arg == '-c':
                 cparm = True
                 continue
@@ -214,8 +246,8 @@ def readCacheFile(basenames, suffix):
     dct = {}
     for name in basenames:
         filename = os.path.join(getTempDirname(), '{}_{}.cache'.format(name, suffix))
-        dat = readAstFile(filename)
-        dct.update(dat)
+        if os.path.isfile(filename):
+            dct.update(readAstFile(filename))
     return dct
 
 
@@ -227,6 +259,10 @@ def readCenterFiles(basenames):
     return readCacheFile(basenames, 'centers')
 
 
+def readPairFiles(basenames):
+    return readCacheFile(basenames, 'pairs')
+
+
 def writeMergedAstFile(astdat, svgname, prefix):
     astFilename = '{}.ast'.format(prefix)
     fil = open(astFilename, 'w')
@@ -236,17 +272,34 @@ def writeMergedAstFile(astdat, svgname, prefix):
 
 
 def writeNeighborCacheFile(basenames, prefix):
+    dat = readNeighborFiles(basenames)
+    if not dat:
+        return
     cacheFile = os.path.join(getTempDirname(), '{}_neighbors.cache'.format(prefix))
     fil = open(cacheFile, 'w')
-    fil.write(prettyPrint(readNeighborFiles(basenames)))
+    fil.write(prettyPrint(dat))
     fil.close()
     print('Wrote {}'.format(cacheFile))
 
 
 def writeCenterCacheFile(basenames, prefix):
+    dat = readCenterFiles(basenames)
+    if not dat:
+        return
     cacheFile = os.path.join(getTempDirname(), '{}_centers.cache'.format(prefix))
     fil = open(cacheFile, 'w')
-    fil.write(prettyPrint(readCenterFiles(basenames)))
+    fil.write(prettyPrint(dat))
+    fil.close()
+    print('Wrote {}'.format(cacheFile))
+
+
+def writePairCacheFile(basenames, prefix):
+    dat = readPairFiles(basenames)
+    if not dat:
+        return
+    cacheFile = os.path.join(getTempDirname(), '{}_pairs.cache'.format(prefix))
+    fil = open(cacheFile, 'w')
+    fil.write(prettyPrint(dat))
     fil.close()
     print('Wrote {}'.format(cacheFile))
 
@@ -259,14 +312,30 @@ def removeHtmlFiles(names):
             pass
 
 
-parseArgs()
+# Builds the merged AST file, as visitour.py would.
+def buildMergedAstFile(prefix):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import visitour
+    visitour.main(['{}.ast'.format(prefix)] + getBuildOptions())
+
+
+def main():
+    parseArgs()
+
+    astData = readAstFiles()
+    baseNames = readBaseNames()
+    svgName = getSvgName(astData)
+    prefix = basename(svgName)
+
+    writeMergedAstFile(astData, svgName, prefix)
+    writeNeighborCacheFile(baseNames, prefix)
+    writeCenterCacheFile(baseNames, prefix)
+    writePairCacheFile(baseNames, prefix)
+    removeHtmlFiles(baseNames)
+    if getBuild():
+        buildMergedAstFile(prefix)
 
-astData = readAstFiles()
-baseNames = readBaseNames()
-svgName = getSvgName(astData)
-prefix = basename(svgName)
 
-writeMergedAstFile(astData, svgName, prefix)
-writeNeighborCacheFile(baseNames, prefix)
-writeCenterCacheFile(baseNames, prefix)
-removeHtmlFiles(baseNames)
+# Worker processes started while building may import this file.
+if __name__ == '__main__':
+    main()